@@ -0,0 +1,215 @@
+"""
+Benchmarks for the pyrelacs loaders.
+
+Generates (or reuses) a synthetic recording (see :mod:`synthetic`) and reports time,
+throughput and peak memory of every loader. Each benchmark runs in a fresh process,
+so that the peak memory of one loader does not hide the one of the next.
+
+Results can be stored as a baseline and later runs compared against it:
+
+    python benchmarks/run.py --size 200MB --save baseline.json
+    python benchmarks/run.py --size 200MB --compare baseline.json
+
+The comparison exits with status 1 if a loader got slower or needs more memory than
+the tolerance allows, or fails although it ran in the baseline. Everything runs offline;
+benchmarks whose dependencies are missing are reported as skipped.
+"""
+from __future__ import print_function
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from synthetic import make_recording
+from pyrelacs import DataClasses
+from pyrelacs import DataLoader
+
+
+def _filesize(basedir, *names):
+    return sum(os.path.getsize(os.path.join(basedir, name)) for name in names)
+
+
+def bench_iload_stimuli(basedir):
+    list(DataLoader.iload(os.path.join(basedir, 'stimuli.dat')))
+    return _filesize(basedir, 'stimuli.dat')
+
+
+def bench_iload_spikes(basedir):
+    list(DataLoader.iload(os.path.join(basedir, 'stimspikes1.dat')))
+    return _filesize(basedir, 'stimspikes1.dat')
+
+
+def bench_load_spikes(basedir):
+    DataLoader.load(os.path.join(basedir, 'stimspikes1.dat'))
+    return _filesize(basedir, 'stimspikes1.dat')
+
+
+def bench_iload_spike_blocks(basedir):
+    list(DataLoader.iload_spike_blocks(os.path.join(basedir, 'stimspikes1.dat')))
+    return _filesize(basedir, 'stimspikes1.dat')
+
+
+def bench_iload_traces(basedir):
+    nbytes = 0
+    for info, key, t, x in DataLoader.iload_traces(basedir, 'FileStimulus', before=0.1, after=0.1):
+        nbytes += x.nbytes
+    return nbytes
+
+
+def bench_iload_trace_trials(basedir):
+    nbytes = 0
+    for info, key, x in DataLoader.iload_trace_trials(basedir, 1, before=0.1, after=0.1):
+        nbytes += x.nbytes
+    return nbytes
+
+
+def bench_relacsfile_select(basedir):
+    stimuli = DataClasses.load(os.path.join(basedir, 'stimuli.dat'))
+    stimuli.select({'RePro': 'SAM'})
+    spikes = DataClasses.load(os.path.join(basedir, 'stimspikes1.dat'))
+    spikes.selectall()
+    return _filesize(basedir, 'stimuli.dat', 'stimspikes1.dat')
+
+
+def bench_relacsdir2nix(basedir):
+    script = os.path.join(os.path.dirname(HERE), 'scripts', 'relacsdir2nix.py')
+    with tempfile.NamedTemporaryFile(suffix='.h5') as nixfile:
+        # the script imports pyrelacs, which need not be installed
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(HERE),
+                                                                         os.environ.get('PYTHONPATH')])))
+        proc = subprocess.Popen([sys.executable, script, basedir, nixfile.name],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            err = err.decode(errors='replace').strip().split('\n')[-1]
+            # only a missing nixio is skipped, everything else is a crash of the converter
+            if err.startswith(('ImportError', 'ModuleNotFoundError')) and 'nixio' in err:
+                raise SkipBenchmark(err)
+            raise RuntimeError('relacsdir2nix.py exited with status %i: %s' % (proc.returncode, err))
+    return _filesize(basedir, *os.listdir(basedir))
+
+
+BENCHMARKS = [
+    ('iload_stimuli', bench_iload_stimuli),
+    ('iload_spikes', bench_iload_spikes),
+    ('load_spikes', bench_load_spikes),
+    ('iload_spike_blocks', bench_iload_spike_blocks),
+    ('iload_traces', bench_iload_traces),
+    ('iload_trace_trials', bench_iload_trace_trials),
+    ('relacsfile_select', bench_relacsfile_select),
+    ('relacsdir2nix', bench_relacsdir2nix),
+]
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def _rss():
+    # resident set size in bytes
+    with open('/proc/self/statm') as fid:
+        return int(fid.read().split()[1]) * resource.getpagesize()
+
+
+def _run(name, basedir, repeat):
+    warnings.simplefilter('ignore')
+    func = dict(BENCHMARKS)[name]
+    rss = _rss()
+    times = []
+    try:
+        for _ in range(repeat):
+            start = time.time()
+            nbytes = func(basedir)
+            times.append(time.time() - start)
+    except SkipBenchmark as e:
+        return {'skipped': str(e)}
+    except ImportError as e:
+        return {'skipped': str(e)}
+    except Exception as e:
+        return {'error': '%s: %s' % (e.__class__.__name__, e)}
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - rss  # ru_maxrss is in kB on Linux
+    return {'time': min(times), 'throughput': nbytes / min(times) / 1e6, 'peak_mb': max(peak, 0) / 1e6}
+
+
+def run(basedir, repeat=3, only=None):
+    """
+    Runs all benchmarks (or the ones in only) on the recording in basedir.
+
+    :returns: dictionary mapping benchmark names to their results
+    """
+    results = {}
+    for name, _ in BENCHMARKS:
+        if only is not None and name not in only:
+            continue
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results[name] = pool.submit(_run, name, basedir, repeat).result()
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    """
+    Prints the results and compares them against a baseline.
+
+    :returns: list of names of the benchmarks that regressed
+    """
+    regressions = []
+    print('%-20s %10s %12s %10s  %s' % ('benchmark', 'time [s]', 'MB/s', 'peak [MB]', ''))
+    for name, res in results.items():
+        if 'time' not in res:
+            note = ''
+            # a benchmark that worked in the baseline and fails now is a regression, too
+            if 'error' in res and baseline is not None and 'time' in baseline.get(name, {}):
+                note = '  REGRESSION'
+                regressions.append(name)
+            print('%-20s %s%s' % (name, res['skipped'] if 'skipped' in res else 'error: ' + res['error'], note))
+            continue
+        note = ''
+        if baseline is not None and 'time' in baseline.get(name, {}):
+            ref = baseline[name]
+            note = '%+.0f%% time, %+.1fMB' % (100.0 * (res['time'] / ref['time'] - 1), res['peak_mb'] - ref['peak_mb'])
+            # a few ms and MB are noise
+            if res['time'] > ref['time'] * (1 + tolerance) + 0.01 or \
+                    res['peak_mb'] > ref['peak_mb'] * (1 + tolerance) + 5.0:
+                note += '  REGRESSION'
+                regressions.append(name)
+        print('%-20s %10.3f %12.1f %10.1f  %s' % (name, res['time'], res['throughput'], res['peak_mb'], note))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the pyrelacs benchmarks on a synthetic recording.')
+    parser.add_argument('--size', default='50MB', help='size of the raw traces of the synthetic recording (default: 50MB)')
+    parser.add_argument('--data', default=None,
+                        help='directory of the recording; generated if it does not exist (default: temporary directory)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repetitions, the fastest one counts (default: 3)')
+    parser.add_argument('--only', default=None, help='comma separated names of the benchmarks to run')
+    parser.add_argument('--save', default=None, help='store the results as baseline in this file')
+    parser.add_argument('--compare', default=None, help='compare the results against the baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown (default: 0.2)')
+    args = parser.parse_args()
+
+    basedir = args.data if args.data is not None else os.path.join(tempfile.gettempdir(), 'pyrelacs-bench-%s' % args.size)
+    if not os.path.isfile(os.path.join(basedir, 'stimuli.dat')):
+        print('generating %s recording in %s' % (args.size, basedir))
+        make_recording(basedir, size=args.size)
+
+    results = run(basedir, args.repeat, None if args.only is None else args.only.split(','))
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fid:
+            baseline = json.load(fid)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save is not None:
+        with open(args.save, 'w') as fid:
+            json.dump(results, fid, indent=2)
+    sys.exit(1 if regressions else 0)
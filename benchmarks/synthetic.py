@@ -0,0 +1,202 @@
+"""
+Generator for synthetic RELACS recording directories.
+
+The generated directories mimic the layout RELACS writes: a ``stimuli.dat`` with a
+nested header, one metadata block per RePro run, multi line keys and one data row per
+trial, continuous ``trace-N.raw`` files with float32 samples, and the spike and
+analysis files (``stimspikes1.dat``, ``samallspikes1.dat``, ``ficurves1.dat``,
+``baseisih1.dat``, ``info.dat``) that refer to the same runs.
+
+>>> make_recording('/tmp/2016-01-01-aa', size='50MB')
+
+"""
+from __future__ import print_function
+import os
+import re
+
+import numpy as np
+
+SAMPLE_INTERVAL = 0.05  # ms
+UNITS = {'': 1, 'k': 1000, 'm': 1000 ** 2, 'g': 1000 ** 3}
+
+
+def parse_size(size):
+    """
+    Converts a size specification like '500MB' or '2GB' into bytes.
+
+    :param size: int or string with an optional kB, MB or GB suffix
+    :return: size in bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    m = re.match(r'^\s*([0-9.]+)\s*([kmg]?)b?\s*$', size.lower())
+    if m is None:
+        raise ValueError("Cannot interpret size %s" % (size,))
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+def _write_header(fid, traces):
+    fid.write('# analog input traces:\n')
+    for i in range(1, traces + 1):
+        fid.write('#      identifier%i: V-%i\n' % (i, i))
+        fid.write('#       data file%i: trace-%i.raw\n' % (i, i))
+        fid.write('# sample interval%i: %gms\n' % (i, SAMPLE_INTERVAL))
+        fid.write('#   sampling rate%i: %.2fHz\n' % (i, 1000.0 / SAMPLE_INTERVAL))
+        fid.write('#            unit%i: mV\n' % (i,))
+    fid.write('# analog output traces:\n')
+    fid.write('#      identifier1: GlobalEField\n')
+    fid.write('#          device1: ao-1\n')
+    fid.write('#         channel1: 0\n')
+    fid.write('\n')
+
+
+def _write_stimuli_key(fid, traces):
+    names = ['V-%i' % i for i in range(1, traces + 1)]
+    cols = 7 * len(names)
+    fid.write('#Key\n')
+    fid.write('# %-*s  %s\n' % (cols, 'traces', 'stimulus'))
+    fid.write('# %s  %s\n' % ('  '.join('%-5s' % n for n in names), 'GlobalEField'))
+    fid.write('# %s  %s\n' % ('  '.join('%-5s' % 'index' for _ in names),
+                              'time    delay  amplitude  duration  signal'))
+    fid.write('# %s  %s\n' % ('  '.join('%-5s' % 'float' for _ in names),
+                              'ms      ms     mV         ms        -'))
+    fid.write('# %s\n' % ('  '.join('%-5i' % i for i in range(1, len(names) + 6)).rstrip(),))
+
+
+def _write_repro(fid, repro, run, duration, contrast):
+    fid.write('#         RePro: %s\n' % (repro,))
+    fid.write('#      RePro ID: %i\n' % (run,))
+    fid.write('#           Run: %i\n' % (run,))
+    fid.write('#      Settings:\n')
+    fid.write('#          duration: %gms\n' % (duration,))
+    fid.write('#          contrast: %g\n' % (contrast,))
+    fid.write('#          repeats: 10\n')
+    fid.write('#          pause: 200ms\n')
+    fid.write('\n')
+
+
+def _write_spike_run(fid, repro, run, trials, duration, contrast, rate, rng):
+    fid.write('#         RePro: %s\n' % (repro,))
+    fid.write('#         index: %i\n' % (run,))
+    fid.write('#      Settings:\n')
+    fid.write('#          duration: %gms\n' % (duration,))
+    fid.write('#          contrast: %g\n' % (contrast,))
+    fid.write('\n')
+    for trial in range(trials):
+        fid.write('#         trial: %i\n' % (trial,))
+        fid.write('\n')
+        if trial == 0:
+            fid.write('#Key\n# t\n# ms\n')
+        n = rng.poisson(duration * rate)
+        if n == 0:
+            fid.write('  -0\n')
+        else:
+            for t in np.sort(rng.uniform(0.0, duration, n)):
+                fid.write('  %9.3f\n' % (t,))
+        fid.write('\n')
+
+
+def make_recording(basedir, size='10MB', traces=2, trials_per_run=20, spike_fraction=0.2, seed=0):
+    """
+    Writes a synthetic recording into basedir.
+
+    The size knob controls the total size of the raw traces. Roughly spike_fraction of
+    the size is added on top as spike files; the firing rate is scaled accordingly.
+
+    :param basedir: directory to write the recording into (created if necessary)
+    :param size: approximate size of the raw traces (e.g. '50MB', '20GB')
+    :param traces: number of analog input traces
+    :param trials_per_run: number of trials per FileStimulus/SAM run
+    :param spike_fraction: size of the spike files relative to the raw traces
+    :param seed: seed of the random number generator
+    :return: basedir
+    """
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(basedir):
+        os.makedirs(basedir)
+    nbytes = parse_size(size)
+    samples = max(nbytes // (4 * traces), 100000)
+    trial_samples = int(1000.0 / SAMPLE_INTERVAL)  # 1s trials + pause
+    pause_samples = int(200.0 / SAMPLE_INTERVAL)
+
+    # raw traces are written in chunks to keep the memory of the generator bounded
+    chunk = 1 << 22
+    for i in range(1, traces + 1):
+        with open(os.path.join(basedir, 'trace-%i.raw' % (i,)), 'wb') as fid:
+            for start in range(0, samples, chunk):
+                n = min(chunk, samples - start)
+                t = np.arange(start, start + n) * SAMPLE_INTERVAL * 1e-3
+                x = np.sin(2 * np.pi * 10 * i * t) + 0.1 * rng.randn(n)
+                x.astype(np.float32).tofile(fid)
+
+    with open(os.path.join(basedir, 'info.dat'), 'w') as fid:
+        fid.write('# Recording:\n#     Date: 2016-01-01\n#     Experimenter: Synthetic\n')
+        fid.write('# Cell:\n#     Species: Apteronotus leptorhynchus\n#     Location: P-unit\n')
+
+    stim = open(os.path.join(basedir, 'stimuli.dat'), 'w')
+    stimspikes = open(os.path.join(basedir, 'stimspikes1.dat'), 'w')
+    samspikes = open(os.path.join(basedir, 'samallspikes1.dat'), 'w')
+    _write_header(stim, traces)
+
+    spike_budget = spike_fraction * nbytes
+    # about 12 bytes per spike, spikes are written during two thirds of the recording
+    rate = max(0.05, spike_budget / (12.0 * samples * SAMPLE_INTERVAL * 2.0 / 3.0))  # spikes per ms
+    pos = pause_samples
+    run = 0
+    repros = ['BaselineActivity', 'FileStimulus', 'SAM']
+    while pos + trial_samples < samples:
+        repro = repros[run % len(repros)]
+        contrast = [0.1, 0.2, 0.3][run % 3]
+        duration = 1000.0
+        _write_repro(stim, repro, run, duration, contrast)
+        _write_stimuli_key(stim, traces)
+        if repro == 'BaselineActivity':
+            stim.write('  %s  %-6g  %-5g  %-9g  %-8s  %s\n' % ('  '.join('%-5i' % pos for _ in range(traces)),
+                                                      0.0, 0.0, 0.0, '0', '-'))
+            pos += trial_samples
+        else:
+            trials = 0
+            while trials < trials_per_run and pos + trial_samples < samples:
+                stim.write('  %s  %-6g  %-5g  %-9g  %-8g  %s\n' % ('  '.join('%-5i' % pos for _ in range(traces)),
+                                                          pos * SAMPLE_INTERVAL, 0.0, contrast, duration,
+                                                          '%s-%i' % (repro, run)))
+                pos += trial_samples + pause_samples
+                trials += 1
+            spikes = stimspikes if repro == 'FileStimulus' else samspikes
+            if spikes.tell() < spike_budget / 2:
+                _write_spike_run(spikes, repro, run, trials, duration, contrast, rate, rng)
+        stim.write('\n')
+        run += 1
+    stim.close()
+    stimspikes.close()
+    samspikes.close()
+
+    with open(os.path.join(basedir, 'ficurves1.dat'), 'w') as fid:
+        for run in range(3):
+            fid.write('# RePro: FICurve\n# index: %i\n# duration: 400ms\n\n' % (run,))
+            fid.write('#Key\n# I      f_s    f_r    f_ss\n# mV     Hz     Hz     Hz\n')
+            for k, intensity in enumerate(np.linspace(-20, 20, 9)):
+                fid.write('  %-5.2f  %-5.1f  %-5.1f  %-5.1f\n' % (intensity, 100 + 5 * k, 90 + 4 * k, 80 + 3 * k))
+            fid.write('\n')
+
+    with open(os.path.join(basedir, 'baseisih1.dat'), 'w') as fid:
+        fid.write('# index: 0\n# rate: 312Hz\n\n')
+        fid.write('#Key\n# t      p\n# ms     1\n')
+        for k in range(100):
+            fid.write('  %-5.2f  %-5.4f\n' % (0.1 * k, np.exp(-0.1 * k)))
+        fid.write('\n')
+
+    return basedir
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Writes a synthetic relacs recording.')
+    parser.add_argument('basedir', help='directory to write the recording into')
+    parser.add_argument('--size', default='10MB', help='approximate size of the raw traces (default: 10MB)')
+    parser.add_argument('--traces', type=int, default=2, help='number of analog input traces (default: 2)')
+    parser.add_argument('--trials', type=int, default=20, help='trials per FileStimulus/SAM run (default: 20)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random number generator')
+    args = parser.parse_args()
+    make_recording(args.basedir, size=args.size, traces=args.traces, trials_per_run=args.trials, seed=args.seed)
+    print(args.basedir)
@@ -0,0 +1,100 @@
+"""
+Cache of the loaded blocks of relacs files with a byte budget.
+
+Every :class:`pyrelacs.DataClasses.RelacsFile.RelacsFile` keeps the blocks it loaded in a
+BlockCache. Without a budget, blocks are kept until the file object dies. With a budget,
+the least recently used blocks are evicted and loaded again from the file when they are
+selected the next time. Pinned blocks are never evicted.
+
+One cache can be shared by many files to bound the memory of a long-running process:
+
+>>> cache = BlockCache(maxbytes=512 * 2**20)
+>>> stimuli = load('2014-06-06-aa/stimuli.dat', cache=cache)
+>>> spikes = load('2014-06-06-aa/stimspikes1.dat', cache=cache)
+>>> cache.hits, cache.misses, cache.evictions
+"""
+from collections import OrderedDict
+
+from ..Instrumentation import nbytes
+
+
+class BlockCache(object):
+    """
+    LRU cache mapping (file token, block index) to loaded (meta, key, data) tuples.
+
+    :param maxbytes: budget for the data of the cached blocks in bytes (None: unlimited)
+    """
+
+    def __init__(self, maxbytes=None):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()  # (token, index) -> (block, size), least recently used first
+        self.pinned = set()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token, index):
+        """
+        Returns the cached block or None.
+        """
+        entry = self.entries.get((token, index))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.pop((token, index))
+        self.entries[(token, index)] = entry
+        return entry[0]
+
+    def put(self, token, index, block):
+        """
+        Stores a block as the most recently used one and evicts the least recently used
+        unpinned blocks until the budget is met.
+        """
+        self.discard(token, index)
+        size = nbytes(block[2])
+        self.entries[(token, index)] = (block, size)
+        self.nbytes += size
+        self._evict()
+
+    def discard(self, token, index):
+        entry = self.entries.pop((token, index), None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def clear(self, token=None):
+        """
+        Removes all blocks (of the file with token if given), including pinned ones.
+        """
+        for k in [k for k in self.entries if token is None or k[0] == token]:
+            self.discard(*k)
+        self.pinned = set(k for k in self.pinned if token is not None and k[0] != token)
+
+    def pin(self, token, index):
+        """
+        Protects a block from eviction. Blocks can be pinned before they are stored, so that
+        storing them cannot evict them right away.
+        """
+        self.pinned.add((token, index))
+
+    def unpin(self, token, index):
+        self.pinned.discard((token, index))
+        self._evict()
+
+    def _evict(self):
+        if self.maxbytes is None or self.nbytes <= self.maxbytes:
+            return
+        for k in list(self.entries):
+            if self.nbytes <= self.maxbytes:
+                break
+            if k not in self.pinned:
+                self.discard(*k)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "BlockCache with %i blocks, %i bytes (budget %s), %i hits, %i misses, %i evictions" % \
+               (len(self.entries), self.nbytes, self.maxbytes, self.hits, self.misses, self.evictions)
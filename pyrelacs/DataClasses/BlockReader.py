@@ -0,0 +1,82 @@
+"""
+Reading the lines of FileRange blocks of a relacs file by their byte offsets.
+
+:func:`pyrelacs.DataClasses.RelacsFile.parse_structure` records the byte offsets of every
+block, so a block is read with a single seek and read instead of line by line. Only the
+requested blocks are held in memory.
+"""
+import io
+from itertools import islice
+
+from .. import Instrumentation
+
+
+def _split_lines(buffer):
+    # universal newlines like a file opened in text mode, the last line always ends with a line break
+    lines = io.StringIO(buffer.decode('utf-8', 'replace'), newline=None).readlines()
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    return lines
+
+
+def _read_lines(filename, start, end):
+    # fallback for FileRanges without byte offsets
+    with io.open(filename, 'r', encoding='utf-8', errors='replace') as fid:
+        lines = list(islice(fid, start, end))
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    return lines
+
+
+def read_block(filename, block):
+    """
+    Returns the lines of a block.
+
+    :param filename: name of the relacs file
+    :param block: FileRange with line numbers start and end (exclusive) and their byte offsets
+    :returns: list of lines including their line breaks
+    """
+    if block.byte_start is None:
+        return _read_lines(filename, block.start, block.end)
+    with open(filename, 'rb') as fid:
+        fid.seek(block.byte_start)
+        buffer = fid.read(block.byte_end - block.byte_start)
+    if Instrumentation.enabled:
+        Instrumentation.count('RelacsFile.bytes read', len(buffer))
+    return _split_lines(buffer)
+
+
+def read_raw_blocks(filename, blocks):
+    """
+    Returns the undecoded bytes of several blocks, e.g. for converting all numbers at once. The
+    span from the first to the last block is read at once.
+
+    :param filename: name of the relacs file
+    :param blocks: list of FileRanges in the order they appear in the file
+    :returns: list with a bytes object for every block
+    """
+    if len(blocks) == 0:
+        return []
+    if any(b.byte_start is None for b in blocks):
+        return [''.join(_read_lines(filename, b.start, b.end)).encode('utf-8') for b in blocks]
+    start = blocks[0].byte_start
+    with open(filename, 'rb') as fid:
+        fid.seek(start)
+        buffer = fid.read(blocks[-1].byte_end - start)
+    if Instrumentation.enabled:
+        Instrumentation.count('RelacsFile.bytes read', len(buffer))
+    return [buffer[b.byte_start - start:b.byte_end - start] for b in blocks]
+
+
+def read_blocks(filename, blocks):
+    """
+    Returns the lines of several blocks, e.g. the merged trials of a spike file. The span from
+    the first to the last block is read at once.
+
+    :param filename: name of the relacs file
+    :param blocks: list of FileRanges in the order they appear in the file
+    :returns: list with a list of lines for every block
+    """
+    if any(b.byte_start is None for b in blocks):
+        return [read_block(filename, b) for b in blocks]
+    return [_split_lines(buffer) for buffer in read_raw_blocks(filename, blocks)]
@@ -1,9 +1,12 @@
 from collections import OrderedDict
-import linecache
 from pprint import pprint
 import types
+from bisect import bisect_left
 from IPython import embed
 import numpy as np
+from .. import Instrumentation
+from ..Instrumentation import timed
+from .BlockReader import read_block
 
 def get_positions(line, elements):
     pos = []
@@ -27,8 +30,9 @@ def position_equalizer(*args):
 
 
 
+@timed('KeyLoaders.parse_stimuli_key')
 def parse_stimuli_key(block, file):
-    lines = [linecache.getline(file, i + 1) for i in range(block.start+1, block.end)]
+    lines = read_block(file, block)[1:]
     idx = [int(i) for i in lines[4][1:].split('  ') if i]
     units = [elem.strip() for elem in lines[3][1:].split('  ') if elem.strip()]
     names = [elem.strip() for elem in lines[2][1:].split('  ') if elem.strip()]
@@ -42,8 +46,9 @@ def parse_stimuli_key(block, file):
     keys = [a+b for a,b in zip(tmp, list(zip(units, idx)))]
     return keys
 
+@timed('KeyLoaders.parse_ficurve_key')
 def parse_ficurve_key(block, file):
-    lines = [linecache.getline(file, i + 1) for i in range(block.start+1, block.end)]
+    lines = read_block(file, block)[1:]
     units = [elem.strip() for elem in lines[1][1:].split('  ') if elem.strip()]
     names = [elem.strip() for elem in lines[0][1:].split('  ') if elem.strip()]
     return list(zip(names, units))
@@ -52,6 +57,7 @@ def parse_ficurve_key(block, file):
 def split_line(line):
     return [e.strip() for e in line.split('  ') if e.strip()]
 
+@timed('KeyLoaders.parse_key')
 def parse_key(block, file):
     """
     Parses the key information from the lines extracted from a relacs file.
@@ -59,7 +65,7 @@ def parse_key(block, file):
     :param lines: lines form a relacs data file
     :return: parsed key information as a list of tuples
     """
-    lines = [linecache.getline(file, i + 1) for i in range(block.start, block.end)]
+    lines = read_block(file, block)
     item_count = [len(l[1:].split()) for l in lines[1:]]
     if len(np.unique(item_count)) == 1: # if there are no keys that count for several below
         return list(zip(*[[e.strip() for e in line[1:].split("  ") if len(e.strip()) > 0] for line in lines[1:]]))
@@ -77,16 +83,20 @@ def parse_key(block, file):
         return keys
 
 
-class KeyFactory:
+class KeyRegistry(object):
     """
-    KeyFactory class that gets a list of FileRange namedtuple objects and a filename. Can be called with
+    KeyRegistry class that gets a list of FileRange namedtuple objects and a filename. Can be called with
     the python with statement to produce the key for a given other FileRange object (usually FileRange objects
-    refering to data). The returned key is the immediately preceeding key in the file.
+    refering to data). The returned key is the immediately preceeding key in the file. Keys are looked up by
+    bisection of their line (or byte) positions.
+
+    Every key block is parsed only once by :meth:`schema`; all data blocks under the key share the parsed
+    columns as a tuple of tuples.
 
     Example:
 
-    >>> with key_factory(FileRange(start=20, end=50, type='data')) as key:
-    >>>     ...
+    >>> with key_registry(FileRange(start=20, end=50, type='data')) as key:
+    >>>     columns = key_registry.schema(key, parse_key)
     """
     def __init__(self, keys, file):
         """
@@ -95,20 +105,56 @@ class KeyFactory:
         :param file: filename the FileRange refer to
         """
         self.keys = sorted(keys, key=lambda e: e.start)
+        self.starts = [k.start for k in self.keys]
+        self.byte_starts = [k.byte_start for k in self.keys]
         self.current_key = None
         self.file = file
+        self.schemas = {}  # (key start, parser name) -> parsed key
+
+    def lookup(self, line=None, byte=None):
+        """
+        Returns the last key starting before a position in the file (or the first key if there is none).
 
+        :param line: line number of the position
+        :param byte: byte offset of the position, used if line is None
+        :returns: FileRange of the key, or None if the file has no keys
+        """
+        if len(self.keys) == 0:
+            return None
+        if line is not None:
+            i = bisect_left(self.starts, line)
+        elif any(b is None for b in self.byte_starts):
+            raise ValueError("The keys of %s have no byte offsets" % (self.file,))
+        else:
+            i = bisect_left(self.byte_starts, byte)
+        return self.keys[i - 1 if i > 0 else 0]
+
+    def schema(self, key, parser=parse_key):
+        """
+        Returns the parsed columns of a key block. The block is parsed with parser the first time it is
+        requested; later requests return the same object.
+
+        :param key: FileRange of the key block
+        :param parser: one of parse_key, parse_stimuli_key, and parse_ficurve_key
+        :returns: tuple of the column tuples
+        """
+        token = (key.start, parser.__name__)
+        ret = self.schemas.get(token)
+        if ret is None:
+            ret = self.schemas[token] = tuple(tuple(c) for c in parser(key, self.file))
+            if Instrumentation.enabled:
+                Instrumentation.count('KeyRegistry.parsed keys')
+        elif Instrumentation.enabled:
+            Instrumentation.count('KeyRegistry.schema hits')
+        return ret
+
+    @timed('KeyRegistry.__call__')
     def __call__(self, elem):
         if type(elem) == list:
             self.current_key = None
-            return self
         else:
-            self.current_key = self.keys[0]
-            i = 1
-            while i < len(self.keys) and self.keys[i].start < elem.start:
-                self.current_key = self.keys[i]
-                i += 1
-            return self
+            self.current_key = self.lookup(elem.start)
+        return self
 
     def __enter__(self):
         return self.current_key
@@ -117,3 +163,4 @@ class KeyFactory:
         pass
 
 
+KeyFactory = KeyRegistry  # former name
@@ -0,0 +1,200 @@
+"""
+Inverted index over the metadata of the blocks of a relacs file.
+
+The index maps every property path (e.g. ('Settings', 'duration')) and value to the sorted list
+of the blocks that have it, so that :meth:`RelacsFile.select` and :meth:`RelacsFile.subkey_select`
+do not need to visit every block. Range predicates are answered from a sorted column of the
+numeric values of a path, converted to SI units:
+
+>>> stimuli = load('2014-06-06-aa/stimuli.dat')
+>>> stimuli.select({('Settings', 'duration'): Range(low='100ms', include_low=False)})
+>>> stimuli.subkey_select(contrast=Range(0.1, 0.3))
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+from ..Quantities import parse_quantity
+
+
+def _numeric(value):
+    # value in SI units and the unit, or None if value is not a number
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value), None
+    if isinstance(value, str):
+        value, unit = parse_quantity(value)
+        if isinstance(value, float):
+            return value, unit
+    return None
+
+
+class Range(object):
+    """
+    Selects values between low and high. Bounds can be numbers or strings with units like
+    '100ms'; values are compared in SI units. If a bound has a unit, only values with the same
+    unit are selected. A bound of None is open.
+
+    Range objects can be used as values in the selections of :meth:`RelacsFile.select` and
+    :meth:`RelacsFile.subkey_select`.
+
+    :param low: lower bound
+    :param high: upper bound
+    :param include_low: whether low itself is selected
+    :param include_high: whether high itself is selected
+    """
+
+    def __init__(self, low=None, high=None, include_low=True, include_high=True):
+        self.low = None if low is None else _numeric(low)
+        self.high = None if high is None else _numeric(high)
+        if (low is not None and self.low is None) or (high is not None and self.high is None):
+            raise ValueError("Range bounds must be numbers")
+        self.include_low = include_low
+        self.include_high = include_high
+        units = set(b[1] for b in (self.low, self.high) if b is not None and b[1] is not None)
+        if len(units) > 1:
+            raise ValueError("Range bounds have different units %s" % (", ".join(sorted(units)),))
+        self.unit = units.pop() if units else None
+
+    def contains(self, value):
+        x = _numeric(value)
+        if x is None or (self.unit is not None and x[1] != self.unit):
+            return False
+        if self.low is not None and (x[0] < self.low[0] or (x[0] == self.low[0] and not self.include_low)):
+            return False
+        if self.high is not None and (x[0] > self.high[0] or (x[0] == self.high[0] and not self.include_high)):
+            return False
+        return True
+
+    # the linear selections compare values with ==
+    __eq__ = contains
+
+    def __ne__(self, value):
+        return not self.contains(value)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Range(%s, %s)" % (self.low, self.high)
+
+
+class MetaIndex(object):
+    """
+    Posting lists of the blocks of a relacs file for every property path and value.
+    The blocks are added in the order of their indices.
+
+    :param size: number of blocks
+    """
+
+    def __init__(self, size):
+        self.postings = {}  # path -> {value: array of block indices}
+        self.unhashable = {}  # path -> [(block index, value)] for values like lists
+        self.blocks = {}  # path -> array of the block indices that have the path
+        self.elements = {}  # element -> [paths containing it]
+        self.inner = set()  # paths of nested dictionaries
+        self.columns = {}  # path -> sorted numeric values, units, block indices; built on demand
+        self.size = size
+
+    def add(self, index, path, value):
+        if path not in self.blocks:
+            self.blocks[path] = array('l')
+            self.postings[path] = {}
+            for e in set(path):
+                self.elements.setdefault(e, []).append(path)
+            for i in range(1, len(path)):
+                self.inner.add(path[:i])
+        self.blocks[path].append(index)
+        try:
+            ids = self.postings[path].get(value)
+            if ids is None:
+                ids = self.postings[path][value] = array('l')
+            ids.append(index)
+        except TypeError:
+            self.unhashable.setdefault(path, []).append((index, value))
+        self.columns.pop(path, None)
+
+    def _column(self, path):
+        if path not in self.columns:
+            entries = [(x, i) for v, idx in self.postings[path].items() for x in [_numeric(v)] if x is not None
+                       for i in idx]
+            entries.extend((x, i) for i, v in self.unhashable.get(path, []) for x in [_numeric(v)] if x is not None)
+            entries.sort(key=lambda e: e[0][0])
+            self.columns[path] = ([e[0][0] for e in entries], [e[0][1] for e in entries], [e[1] for e in entries])
+        return self.columns[path]
+
+    def _range(self, path, r):
+        values, units, blocks = self._column(path)
+        lo, hi = 0, len(values)
+        if r.low is not None:
+            lo = (bisect_left if r.include_low else bisect_right)(values, r.low[0])
+        if r.high is not None:
+            hi = (bisect_right if r.include_high else bisect_left)(values, r.high[0])
+        return [b for b, u in zip(blocks[lo:hi], units[lo:hi]) if r.unit is None or u == r.unit]
+
+    def match(self, path, value):
+        """
+        Returns the sorted indices of the blocks whose value at path equals value (or lies in a
+        :class:`Range`), or None if the index cannot answer the query (e.g. for unhashable values).
+        """
+        if path not in self.blocks:
+            return None if path in self.inner else []
+        if path in self.inner:
+            return None  # some blocks have a nested dictionary at path
+        if isinstance(value, Range):
+            return sorted(self._range(path, value))
+        try:
+            hits = list(self.postings[path].get(value, []))
+        except TypeError:
+            return None
+        hits.extend(i for i, v in self.unhashable.get(path, []) if v == value)
+        return sorted(hits)
+
+    def select(self, selection):
+        """
+        Returns the sorted indices of the blocks matching all items of the selection like
+        :func:`exact_nested_field_match`, or None if the index cannot answer it.
+        """
+        candidates = None
+        for k, v in selection.items():
+            hits = self.match(k if type(k) is tuple else (k,), v)
+            if hits is None:
+                return None
+            candidates = hits if candidates is None else _intersect(candidates, hits)
+        return list(range(self.size)) if candidates is None else candidates
+
+    def subkey_select(self, selection):
+        """
+        Returns the sorted indices of the blocks matching all items of the selection like
+        :func:`subkey_field_match`, or None if the index cannot answer it.
+
+        :raise KeyError: if a key occurs in more than one property of a candidate block
+        """
+        candidates = None
+        for k, v in selection.items():
+            try:
+                paths = self.elements.get(k, [])
+            except TypeError:
+                return None
+            if len(paths) > 1:
+                inside = None if candidates is None else set(candidates)
+                counts = Counter(i for p in paths for i in self.blocks[p] if inside is None or i in inside)
+                if any(c > 1 for c in counts.values()):
+                    raise KeyError("Key %s is not unique!" % (k,))
+            hits = []
+            for p in paths:
+                h = self.match(p, v)
+                if h is None:
+                    return None
+                hits.extend(h)
+            hits.sort()
+            candidates = hits if candidates is None else _intersect(candidates, hits)
+        return list(range(self.size)) if candidates is None else candidates
+
+
+def _intersect(a, b):
+    # intersection of two sorted lists
+    if len(a) > len(b):
+        a, b = b, a
+    s = set(b)
+    return [i for i in a if i in s]
@@ -1,8 +1,17 @@
-import linecache
 import re
 import types
 import yaml
+from yaml.nodes import ScalarNode
+from yaml.resolver import Resolver
 from IPython import embed
+from ..Instrumentation import timed
+from .BlockReader import read_block
+from ..Quantities import lru_cache
+from .MetaViews import MetaView, Mapping
+try:
+    from sys import intern
+except ImportError:  # python 2
+    pass
 
 
 def flatten_dict(d, prefix=None):
@@ -20,7 +29,7 @@ def flatten_dict(d, prefix=None):
     ret = {}
     for k, v in d.items():
         k = re.sub('[^0-9a-zA-Z_]+', '', k.lower().replace(" ", "_"))
-        if type(v) == dict:
+        if isinstance(v, Mapping):
             ret.update(flatten_dict(v, prefix + [k]))
         else:
             ret["__".join(prefix + [k])] = v
@@ -41,22 +50,147 @@ def parse_old_meta(meta):
     ret['description'] = ', '.join(ret['description'])
     return ret
 
+@timed('MetaLoaders.parse_meta')
 def parse_meta(block, filename):
-    meta = [linecache.getline(filename, i + 1)[1:] for i in range(block.start, block.end)]
+    """
+    Parses a metadata block of a relacs file.
+
+    :param block: FileRange of the block
+    :param filename: name of the relacs file
+    :return: the metadata as read-only :class:`pyrelacs.DataClasses.MetaViews.MetaView` with nested
+             MetaViews for the nested sections. Blocks with the same text share their views.
+    """
+    return _parse_meta_text(''.join(line[1:] for line in read_block(filename, block)))
+
+
+@lru_cache(maxsize=4096)
+def _parse_meta_text(text):
+    # relacs writes many identical blocks, so the parsed blocks are cached by their text and
+    # handed out as read-only views to all blocks (of all files) with that text
+    lines = text.splitlines(True)
+    ret = parse_indented_meta(lines)
+    if ret is INVALID:
+        # yaml would fail as well, the original indentation is fixed like below
+        try:
+            ret = parse_indented_meta(fix_meta_block(list(lines)))
+        except IndexError:
+            ret = None
+    if ret is None or ret is INVALID:
+        ret = _intern(_parse_meta_yaml(lines))
+    return _freeze(ret)
+
+
+def _parse_meta_yaml(meta):
     try:
-        tmp =  yaml.load(''.join(meta))
+        tmp = yaml.safe_load(''.join(meta))
         if type(tmp) == str:
             return parse_old_meta(meta)
         else:
             return tmp
     except:
-        tmp = yaml.load(''.join(fix_meta_block(meta)))
+        tmp = yaml.safe_load(''.join(fix_meta_block(meta)))
         if type(tmp) == str:
             return parse_old_meta(meta)
         else:
             return tmp
 
 
+def _intern(meta):
+    # the same keys and values appear in every block, so their strings are shared
+    if type(meta) == dict:
+        return dict((_intern(k), _intern(v)) for k, v in meta.items())
+    elif type(meta) == str:
+        return intern(meta)
+    return meta
+
+
+def _freeze(meta):
+    # nested dictionaries become read-only views as well
+    if type(meta) == dict:
+        return MetaView(dict((k, _freeze(v)) for k, v in meta.items()))
+    return meta
+
+
+INVALID = object()
+_indicators = set('-?:,[]{}#&*!|>\'"%@`')
+_resolver = Resolver()
+_decimal_int = re.compile(r'^[-+]?(0|[1-9][0-9]*)$')
+_decimal_float = re.compile(r'^[-+]?[0-9]+\.[0-9]*([eE][-+][0-9]+)?$')
+
+
+@lru_cache(maxsize=4096)
+def _scalar(value):
+    # the value of a plain scalar as yaml constructs it
+    tag = _resolver.resolve(ScalarNode, value, (True, False))
+    if tag == 'tag:yaml.org,2002:str':
+        return intern(value)
+    elif tag == 'tag:yaml.org,2002:int' and _decimal_int.match(value):
+        return int(value)
+    elif tag == 'tag:yaml.org,2002:float' and _decimal_float.match(value):
+        return float(value)
+    return yaml.safe_load(value)
+
+
+def _plain(s):
+    # whether s is a plain scalar that can be handled without yaml
+    return s and s[0] not in _indicators and ' #' not in s and ': ' not in s and not s.endswith(':') \
+        and '\t' not in s or (len(s) > 1 and s[0] == '-' and s[1] != ' ' and _plain(s[1:]))
+
+
+def parse_indented_meta(lines):
+    """
+    Parses the indentation based key: value layout of relacs metadata blocks without yaml.
+
+    :param lines: lines of the block without the leading #
+    :return: nested dictionary like yaml.load, INVALID if yaml would fail because of the
+             indentation, or None if the block needs the full yaml parser
+    """
+    root = {}
+    stack = []  # indentation and dictionary of the open mappings
+    pending = None  # dictionary, key, and indentation of a key without value
+    for line in lines:
+        content = line.rstrip('\r\n').rstrip(' ')
+        stripped = content.lstrip(' ')
+        if not stripped:
+            continue
+        indent = len(content) - len(stripped)
+        if stripped.endswith(':') and ': ' not in stripped:
+            key, value = stripped[:-1].rstrip(' '), None
+        elif ': ' in stripped:
+            key, value = stripped.split(': ', 1)
+            key, value = key.rstrip(' '), value.lstrip(' ')
+            if not _plain(value):
+                return None
+        else:
+            return None
+        if not _plain(key) or ':' in key or key == '<<':
+            return None
+
+        if pending is not None:
+            d, k, i = pending
+            pending = None
+            if indent > i:
+                d[k] = {}
+                stack.append((indent, d[k]))
+            else:
+                d[k] = None
+        if not stack:
+            stack.append((indent, root))
+        while indent < stack[-1][0]:
+            stack.pop()
+            if not stack:
+                return INVALID
+        if indent != stack[-1][0]:
+            return INVALID
+        if value is None:
+            pending = stack[-1][1], _scalar(key), indent
+        else:
+            stack[-1][1][_scalar(key)] = _scalar(value)
+    if pending is not None:
+        pending[0][pending[1]] = None
+    return root if stack else None
+
+
 
 def fix_meta_block(meta):
     indent_stack = [(len(meta[0]) - len(meta[0].lstrip())) * ' ']
@@ -0,0 +1,84 @@
+"""
+Read-only, layered metadata of the blocks of a relacs file.
+
+The metadata of a data block consists of the metadata blocks above it in the file (e.g. the
+session, the RePro run, and the trial). Instead of copying the inherited metadata into every
+block, a :class:`MetaView` keeps the own items of a block and refers to the view of its parent,
+so all trials of a run share the metadata of the run.
+"""
+import copy
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+
+class MetaView(Mapping):
+    """
+    Read-only mapping of the own metadata items of a block layered over the metadata of its
+    parent. Own items override the ones of the parent. Items are ordered like a copy of the
+    parent updated with the own items.
+
+    The views are shared between blocks, so nested sections are read-only MetaViews as well;
+    use :meth:`flatten` to get a private copy as nested dictionaries.
+
+    :param own: dictionary with the items of the block
+    :param parent: MetaView or dictionary of the parent block, or None
+    """
+    __slots__ = ('_own', '_parent')
+
+    def __init__(self, own, parent=None):
+        self._own = own._own if isinstance(own, MetaView) and own._parent is None else own
+        self._parent = parent
+
+    def __getitem__(self, key):
+        if key in self._own:
+            return self._own[key]
+        if self._parent is not None:
+            return self._parent[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._own or (self._parent is not None and key in self._parent)
+
+    def __iter__(self):
+        if self._parent is not None:
+            for k in self._parent:
+                yield k
+            for k in self._own:
+                if k not in self._parent:
+                    yield k
+        else:
+            for k in self._own:
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def with_parent(self, parent):
+        """
+        Returns a view with the own items of this view layered over parent.
+        """
+        return MetaView(self._own if self._parent is None else self, parent)
+
+    def copy(self):
+        """
+        Returns the items as a (shallow) dictionary, like dict.copy. Nested sections stay MetaViews.
+        """
+        return dict(self.items())
+
+    def flatten(self):
+        """
+        Returns the metadata as a nested dictionary that is independent of all other blocks.
+        """
+        return _thaw(self)
+
+
+def _thaw(value):
+    # nested dictionaries of the items of a mapping, copies of all other values
+    if isinstance(value, Mapping):
+        return dict((k, _thaw(v)) for k, v in value.items())
+    return copy.deepcopy(value)
@@ -1,6 +1,6 @@
 from collections import defaultdict
-import linecache
 from pprint import pprint
+import os
 import types
 import warnings
 import numpy as np
@@ -8,10 +8,20 @@ from collections import namedtuple
 from ast import literal_eval
 from IPython import embed
 
-from .KeyLoaders import KeyFactory, parse_key, parse_stimuli_key, parse_ficurve_key
+from .KeyLoaders import KeyRegistry, parse_key, parse_stimuli_key, parse_ficurve_key
 from .MetaLoaders import parse_meta
-
-FileRange = namedtuple('FileRange', ['start', 'end', 'type'])
+from .BlockReader import read_block, read_raw_blocks
+from .MetaIndex import MetaIndex
+from .MetaViews import MetaView, Mapping
+from .BlockCache import BlockCache
+from .StimuliTable import decode_stimuli_block
+from ..SpikeTrains import RaggedSpikes
+from ..Quantities import lru_cache
+from .. import Instrumentation
+from ..Instrumentation import timed
+
+FileRange = namedtuple('FileRange', ['start', 'end', 'type', 'byte_start', 'byte_end'])
+FileRange.__new__.__defaults__ = (None, None)  # byte offsets are optional
 MetaDataBlock = namedtuple('MetaDataBlock', ['meta', 'data'])
 DataBlock = namedtuple('DataBlock', ['key', 'meta', 'data'])
 
@@ -27,6 +37,16 @@ def str2number(s):
         return s
 
 
+def _file_stamp(filename):
+    # size and modification time are part of the cache tokens, so that a file that is still
+    # being written does not get the blocks cached for an older version
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+_cell2number = lru_cache(maxsize=65536)(str2number)  # the cells of stimuli files repeat a lot
+
+
 def parse_metadata_hierarchy(structure):
     """
     Parses the structure of a relacs file into its hierarchy. The structure is given as a list of FileRanges and
@@ -62,7 +82,7 @@ def get_properties(meta, parent=None):
     if parent is None: parent = tuple()
     #    print meta
     for m, v in meta.items():
-        if type(v) == dict:
+        if isinstance(v, Mapping):
             ret.update(get_properties(v, parent + (m,)))
         else:
             ret.add(parent + (m,))
@@ -88,7 +108,7 @@ def parse_metadata_data_block(block, key_factory, filename, inherited_props=None
     a data field. The data can still be a FileRange to allow lazy loading.
 
     :param block: MetaDataBlock object
-    :param key_factory: The KeyFactory figuring out the key for the block.
+    :param key_factory: The KeyRegistry figuring out the key for the block.
     :param filename: path to the relacs file the data is parsed from
     :param inherited_props: used for recursion. Not important on the upper level
     :return: A DataBlock
@@ -97,9 +117,7 @@ def parse_metadata_data_block(block, key_factory, filename, inherited_props=None
 
         meta = parse_meta(block.meta, filename)
         if inherited_props is not None:
-            tmp = inherited_props.copy()
-            tmp.update(meta)
-            meta = tmp
+            meta = meta.with_parent(inherited_props)
 
         if type(block.data) == list:
             ret = []
@@ -114,46 +132,52 @@ def parse_metadata_data_block(block, key_factory, filename, inherited_props=None
             )]
 
 
+@timed('RelacsFile.parse_structure')
 def parse_structure(filename, verbose=False):
     """
     Parses the structure of a relacs file.
 
     :param filename: path to the file
     :param verbose: print out messages during the parsing process
-    :return: a list of FileRange namedtuples representing meta and data parts and a list of FileRange namedtuples with key information
+    :return: a list of FileRange namedtuples representing meta and data parts and a list of FileRange namedtuples with key information.
+             Besides the line numbers, the FileRanges contain the byte offsets of the blocks.
 
     >>> structure, keys = parse_structure('stimspikes1.dat')
 
     """
     if verbose: print(filename, 80 * '-')
     within_key = within_meta_block = within_data_block = False
-    start = None
+    start = byte_start = None
+    offset = 0
     structure = []
     keys = []
-    with open(filename, 'r') as fid:
+    line_no = -1
+    with open(filename, 'rb') as fid:
         for line_no, line in enumerate(fid):
-            line = line.rstrip().lstrip()
+            pos = offset
+            offset += len(line)
+            line = line.strip()
             if not line:  # something ends
                 if within_data_block:
-                    structure.append(FileRange(start, line_no, 'data'))
+                    structure.append(FileRange(start, line_no, 'data', byte_start, pos))
                     within_data_block = False
                     if verbose: print("DATA END", line[:20], line_no)
                 elif within_meta_block:
-                    structure.append(FileRange(start, line_no, 'meta'))
+                    structure.append(FileRange(start, line_no, 'meta', byte_start, pos))
                     if verbose: print("META END", line[:20], line_no)
                     within_meta_block = False
                 elif within_key:
                     if verbose: print("KEY END", line[:20], line_no)
                     within_key = False
-                    keys.append(FileRange(start, line_no, 'key'))
-                start = None
+                    keys.append(FileRange(start, line_no, 'key', byte_start, pos))
+                start = byte_start = None
                 continue
 
-            elif line.startswith('#'):
-                if line.startswith('#Key'):
+            elif line.startswith(b'#'):
+                if line.startswith(b'#Key'):
                     if verbose: print("KEY START", line[:20], line_no)
                     within_key = True
-                    start = line_no
+                    start, byte_start = line_no, pos
                     continue
                 elif within_key:
                     continue
@@ -161,20 +185,20 @@ def parse_structure(filename, verbose=False):
                     continue
                 else:  # meta block starts
                     if verbose: print("META START", line[:20], line_no)
-                    start = line_no
+                    start, byte_start = line_no, pos
                     within_meta_block = True
             else:  # line is not empty and does not start with #
                 if within_meta_block:
                     if verbose: print("META END", line[:20], line_no)
-                    structure.append(FileRange(start, line_no, 'meta'))
+                    structure.append(FileRange(start, line_no, 'meta', byte_start, pos))
                     within_meta_block = False
                 if within_key:
                     if verbose: print("KEY END", line[:20], line_no)
                     within_key = False
-                    keys.append(FileRange(start, line_no, 'key'))
+                    keys.append(FileRange(start, line_no, 'key', byte_start, pos))
 
                 if not within_data_block:
-                    start = line_no
+                    start, byte_start = line_no, pos
                     if verbose: print("DATA START", line[:20], line_no)
                     within_data_block = True
 
@@ -182,8 +206,10 @@ def parse_structure(filename, verbose=False):
             if within_data_block:
                 if verbose: print("DATA END", line[:20], line_no)
                 within_data_block = False
-                structure.append(FileRange(start, line_no + 1, 'data'))
+                structure.append(FileRange(start, line_no + 1, 'data', byte_start, offset))
             if verbose: print("FILE END", line[:20], line_no)
+            if Instrumentation.enabled:
+                Instrumentation.count('RelacsFile.lines read', line_no + 1)
 
     return structure, keys
 
@@ -201,12 +227,13 @@ def print_hierarchy(hierarchy, indent='', hlevel=0):
             print('What the hell is this?', h)
 
 
+@timed('RelacsFile.relacs_file_factory')
 def relacs_file_factory(obj, mergetrials=False):
     structure, keys = parse_structure(obj.filename)
     hierarchy = parse_metadata_hierarchy(structure)
 
-    key_factory = KeyFactory(keys, obj.filename)
-    ret, fields = hierarchy2datablocks(hierarchy, key_factory, obj.filename)
+    obj.key_registry = KeyRegistry(keys, obj.filename)
+    ret, fields = hierarchy2datablocks(hierarchy, obj.key_registry, obj.filename)
     if mergetrials:
         if obj.__class__ is SpikeFile:
             ret = _merge_stimspike_trials(ret, obj.filename)
@@ -216,10 +243,12 @@ def relacs_file_factory(obj, mergetrials=False):
     obj.content = [(block.meta, block.key, block.data) for block in ret]
 
     obj.fields = defaultdict(set)
-    for p, _, _ in obj.content:
+    obj.index = MetaIndex(len(obj.content))
+    for i, (p, _, _) in enumerate(obj.content):
         for f in fields:
             try:
                 tmp = get_nested_value(p, f)
+                obj.index.add(i, f, tmp)
                 if type(tmp) == list:
                     tmp = tuple(tmp)
                 obj.fields[f].add(tmp)
@@ -314,15 +343,27 @@ class RelacsFile(object):
 
     **filename:** the filename the data comes from.
 
+    **key_registry:** :class:`pyrelacs.DataClasses.KeyLoaders.KeyRegistry` with the keys of the file, each parsed only once
+
+    **index:** :class:`pyrelacs.DataClasses.MetaIndex.MetaIndex` of the metadata used by select and subkey_select.
+    Selections can contain :class:`pyrelacs.DataClasses.MetaIndex.Range` objects as values.
+
+    **cache:** :class:`pyrelacs.DataClasses.BlockCache.BlockCache` with the loaded blocks
+
     When a relacs file is instantiated, the data is not actually loaded. This happens lazyly in select where each item
-    is loaded when it is requested. Once it is loaded it stays stored in the RelacsFile object.
+    is loaded when it is requested. Once it is loaded it stays stored in the cache. Without a budget (the default)
+    blocks are kept as long as the RelacsFile object; with a budget (BlockCache(maxbytes)), the least recently used
+    blocks are dropped and loaded again when needed. A cache can be shared between RelacsFile objects.
 
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache=None):
         self.filename = filename
+        self.cache = BlockCache() if cache is None else cache
+        self._cache_token = (self.__class__.__name__, filename) + _file_stamp(filename)
         self = relacs_file_factory(self, mergetrials=False)
 
+    @timed('RelacsFile._finalize_selection')
     def _finalize_selection(self, metas, keys, datas, idx):
         if len(metas) == 0:
             return None
@@ -330,13 +371,42 @@ class RelacsFile(object):
         for i, j in enumerate(idx):
             if isinstance(datas[i], FileRange) or \
                     (type(datas[i]) == list and isinstance(datas[i][0], FileRange)):
-                _, keys[i], datas[i] = self._load(j)
+                _, keys[i], datas[i] = self._get(j)
 
         return metas, keys, datas
 
+    def _get(self, item_index):
+        # the loaded block from the cache, loaded from the file on a miss
+        block = self.cache.get(self._cache_token, item_index)
+        if block is None:
+            block = self._load(item_index)
+            if Instrumentation.enabled:
+                Instrumentation.count('RelacsFile.cache misses')
+                Instrumentation.count('RelacsFile.loaded bytes', Instrumentation.nbytes(block[2]))
+        elif Instrumentation.enabled:
+            Instrumentation.count('RelacsFile.cache hits')
+        return block
+
+    def pin(self, item_index):
+        """
+        Loads the block item_index of content and keeps it in the cache until :meth:`unpin` is called.
+        """
+        # pinned first, so that storing the block cannot evict it right away
+        self.cache.pin(self._cache_token, item_index)
+        self._get(item_index)
+
+    def unpin(self, item_index):
+        self.cache.unpin(self._cache_token, item_index)
+
+    def clear_cache(self):
+        """
+        Drops all loaded blocks of this file from the cache, including pinned ones.
+        """
+        self.cache.clear(self._cache_token)
+
     def data_blocks(self):
         for i in range(len(self.content)):
-            yield self._load(i)
+            yield self._get(i)
 
     def select(self, selection=None, **kwargs):
         ret = self._select(exact_nested_field_match, selection, **kwargs)
@@ -365,23 +435,43 @@ class RelacsFile(object):
 
         idx, metas, keys, datas = [], [], [], []
 
-        for i, (meta, key, data) in enumerate(self.content):
-            if selectionfunc(meta, selection):
+        # the index answers the selections of select and subkey_select without visiting every block
+        hits = None
+        if selectionfunc is exact_nested_field_match:
+            hits = self.index.select(selection)
+        elif selectionfunc is subkey_field_match:
+            hits = self.index.subkey_select(selection)
+        if Instrumentation.enabled:
+            Instrumentation.count('RelacsFile.index %s' % ('misses' if hits is None else 'hits'))
+
+        if hits is not None:
+            for i in hits:
+                meta, key, data = self.content[i]
                 metas.append(meta)
                 keys.append(key)
                 datas.append(data)
                 idx.append(i)
+        else:
+            for i, (meta, key, data) in enumerate(self.content):
+                if selectionfunc(meta, selection):
+                    metas.append(meta)
+                    keys.append(key)
+                    datas.append(data)
+                    idx.append(i)
         return self._finalize_selection(metas, keys, datas, idx)
 
+    @timed('RelacsFile._load')
     def _load(self, item_index, replace=True, loadkey=True):
         meta, key, block = self.content[item_index]
 
-        data = [linecache.getline(self.filename, i + 1) for i in range(block.start, block.end)]
+        data = read_block(self.filename, block)
+        if Instrumentation.enabled:
+            Instrumentation.count('RelacsFile.lines loaded', block.end - block.start)
         if loadkey:
-            key = parse_key(key, self.filename)
+            key = self.key_registry.schema(key, parse_key)
 
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
 
         return meta, key, data
 
@@ -401,7 +491,7 @@ def _merge_stimspike_trials(blocks, filename):
     tmp = [blocks[0].data]
     first = last = blocks[0].meta['trial']
     key = blocks[0].key
-    meta = dict(blocks[0].meta)
+    meta = blocks[0].meta
 
     for i, block in enumerate(blocks):
         if i == 0: continue
@@ -409,107 +499,167 @@ def _merge_stimspike_trials(blocks, filename):
             last += 1
             tmp.append(block.data)
         else:
-            meta['trial'] = (first, last + 1)
-            ret.append(DataBlock(meta=meta, key=key, data=tmp))
+            ret.append(DataBlock(meta=MetaView({'trial': (first, last + 1)}, meta), key=key, data=tmp))
 
             tmp = [block.data]
 
             key = block.key
-            meta = dict(block.meta)
+            meta = block.meta
             first = last = meta['trial']
     else:
         if len(tmp) > 0:
-            meta['trial'] = (first, last + 1)
-            ret.append(DataBlock(meta=meta, key=key, data=tmp))
+            ret.append(DataBlock(meta=MetaView({'trial': (first, last + 1)}, meta), key=key, data=tmp))
     return ret
 
 
+@timed('RelacsFile.decode_numbers')
+def decode_numbers(buffers):
+    """
+    Converts the numbers in the lines of several blocks (e.g. the merged trials of a spike file)
+    with a single NumPy call.
+
+    :param buffers: list of bytes objects with the lines of each block
+    :returns: array with the numbers of all blocks (one dimensional for a single column, rows x
+              columns otherwise) and the number of rows of each block
+    :raise ValueError: if the blocks have different numbers of columns or cells are no numbers
+    """
+    first = next((b for b in buffers if b.strip()), b'')
+    ncols = max(len(first.lstrip().split(b'\n', 1)[0].split()), 1)
+    rows = [b.count(b'\n') + (0 if b.endswith(b'\n') or not b.strip() else 1) for b in buffers]
+    if ncols > 1 and any(len(set(map(len, map(bytes.split, b.splitlines())))) > 1 for b in buffers):
+        raise ValueError("Blocks with different numbers of columns cannot be converted together")
+    with warnings.catch_warnings():
+        # numpy only warns if the text contains something else than numbers
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(b'\n'.join(buffers), dtype=np.float64, sep=' ')
+        except DeprecationWarning:
+            raise ValueError("Blocks contain cells that are no numbers")
+    if len(values) != sum(rows) * ncols:
+        raise ValueError("Blocks with different numbers of columns cannot be converted together")
+    return (values if ncols == 1 else values.reshape(-1, ncols)), rows
+
+
 class SpikeFile(RelacsFile):
-    def __init__(self, filename, mergetrials=True):
+    """
+    Relacs file with spike times. With mergetrials=True, consecutive trials are merged into a
+    single data entry. With ragged=True, merged trials are returned as a
+    :class:`pyrelacs.SpikeTrains.RaggedSpikes` object instead of a list of arrays.
+    """
+
+    def __init__(self, filename, mergetrials=True, ragged=False, cache=None):
         self.filename = filename
+        self.ragged = ragged
+        self.cache = BlockCache() if cache is None else cache
+        self._cache_token = (self.__class__.__name__, filename, mergetrials, ragged) + _file_stamp(filename)
 
         self = relacs_file_factory(self, mergetrials=mergetrials)
 
+    @timed('SpikeFile._load')
     def _load(self, item_index, replace=True, loadkey=True):
         meta, key, block = self.content[item_index]
 
         data = []
+        if Instrumentation.enabled:
+            Instrumentation.count('RelacsFile.lines loaded', sum(b.end - b.start for b in block) if type(block) == list
+                                  else block.end - block.start)
         if type(block) == list:
-            for b in block:
-                tmp = np.array([float(linecache.getline(self.filename, i + 1)) for i in range(b.start, b.end)])
-                data.append(tmp)
+            # all trials of a run are converted at once
+            values, rows = decode_numbers(read_raw_blocks(self.filename, block))
+            offsets = np.zeros(len(rows) + 1, dtype=np.intp)
+            np.cumsum(rows, out=offsets[1:])
+            if self.ragged:
+                if values.ndim > 1:
+                    raise ValueError("Only spike times with a single column can be ragged")
+                data = RaggedSpikes(values, offsets)
+            else:
+                data = [values[offsets[i]:offsets[i + 1]] for i in range(len(rows))]
         elif isinstance(block, FileRange):
-            try:
-                data = np.array([float(linecache.getline(self.filename, i + 1)) for i in range(block.start, block.end)])
-            except:
-                data = (np.asarray([linecache.getline(self.filename, i + 1).strip().split() for i in range(block.start, block.end)])).astype(np.float)
+            data, _ = decode_numbers(read_raw_blocks(self.filename, [block]))
 
         if loadkey:
-            key = parse_key(key, self.filename)
+            key = self.key_registry.schema(key, parse_key)
 
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
 
         return meta, key, data
 
 class StimuliFile(RelacsFile):
-    def __init__(self, filename):
-        super(StimuliFile, self).__init__(filename)
+    """
+    Relacs file with the trials of the stimuli. With columnar=True, the data of a block is a
+    :class:`pyrelacs.DataClasses.StimuliTable.StimuliTable` with typed columns instead of a list
+    of rows.
+    """
+
+    def __init__(self, filename, cache=None, columnar=False):
+        self.columnar = columnar
+        super(StimuliFile, self).__init__(filename, cache)
+        if columnar:
+            self._cache_token += (columnar,)
 
+    @timed('StimuliFile._load')
     def _load(self, item_index, replace=True):
         meta, key, data = super(StimuliFile, self)._load(item_index, replace=False, loadkey=False)
-        key = parse_stimuli_key(key, self.filename)
-        data = [[str2number(elem.strip()) for elem in line.split('  ') if elem.strip()] for line in data]
+        key = self.key_registry.schema(key, parse_stimuli_key)
+        if self.columnar:
+            data = decode_stimuli_block(data, key)
+        else:
+            data = [[_cell2number(elem.strip()) for elem in line.split('  ') if elem.strip()] for line in data]
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
         return meta, key, data
 
 class BeatFile(RelacsFile):
-    def __init__(self, filename):
-        super(BeatFile, self).__init__(filename)
+    def __init__(self, filename, cache=None):
+        super(BeatFile, self).__init__(filename, cache)
 
+    @timed('BeatFile._load')
     def _load(self, item_index, replace=True):
         meta, key, data = super(BeatFile, self)._load(item_index, replace=False, loadkey=False)
-        key = parse_key(key, self.filename)
+        key = self.key_registry.schema(key, parse_key)
         data = [[str2number(elem.strip()) for elem in line.strip().split()] for line in data]
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
         return meta, key, data
 
 class TraceFile(RelacsFile):
-    def __init__(self, filename):
-        super(TraceFile, self).__init__(filename)
+    def __init__(self, filename, cache=None):
+        super(TraceFile, self).__init__(filename, cache)
 
+    @timed('TraceFile._load')
     def _load(self, item_index, replace=True):
         meta, key, data = super(TraceFile, self)._load(item_index, replace=False, loadkey=True)
         data = np.asarray([[str2number(elem.strip()) for elem in line.strip().split()] for line in data])
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
         return meta, key, data
 
 
 class EventFile(RelacsFile):
-    def __init__(self, filename):
-        super(EventFile, self).__init__(filename)
+    def __init__(self, filename, cache=None):
+        super(EventFile, self).__init__(filename, cache)
 
+    @timed('EventFile._load')
     def _load(self, item_index, replace=True):
         meta, key, data = super(EventFile, self)._load(item_index, replace=False, loadkey=False)
-        key = parse_key(key, self.filename)
+        key = self.key_registry.schema(key, parse_key)
         data = np.asarray([[str2number(elem.strip()) for elem in line.strip().split()] for line in data])
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
         return meta, key, data
 
 class FICurveFile(StimuliFile):
-    def __init__(self, filename):
-        super(FICurveFile, self).__init__(filename)
+    def __init__(self, filename, cache=None):
+        super(FICurveFile, self).__init__(filename, cache)
 
+    @timed('FICurveFile._load')
     def _load(self, item_index, replace=True):
         meta, key, data = super(StimuliFile, self)._load(item_index, replace=False, loadkey=False)
-        key = parse_ficurve_key(key, self.filename)
+        key = self.key_registry.schema(key, parse_ficurve_key)
         data = np.array([[str2number(elem.strip()) for elem in line.split('  ') if elem.strip()] for line in data])
         if replace:
-            self.content[item_index] = (meta, key, data)
+            self.cache.put(self._cache_token, item_index, (meta, key, data))
         return meta, key, data
 
 def read_info_file(file_name):
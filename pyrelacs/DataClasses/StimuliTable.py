@@ -0,0 +1,145 @@
+"""
+Typed columns of the data blocks of stimuli.dat.
+
+Each row of a stimuli.dat block is a trial: the sample indices of the traces, the time, and the
+parameters of the stimulus. :func:`decode_stimuli_block` converts a whole block into one NumPy
+array per column instead of a list of lists of Python objects. The kind of each column is taken
+from the unit row of the stimuli key: columns with the unit '-' hold text like signal names and
+are dictionary encoded, all others are numbers. Cells that are '-0' or missing are masked.
+
+>>> stimuli = StimuliFile('2014-06-06-aa/stimuli.dat', columnar=True)
+>>> meta, key, tables = stimuli.select({'RePro': 'SAM'})
+>>> starts = tables[0].column('index')  # masked if a trial is incomplete
+>>> signals = tables[0].column('signal')
+"""
+import numpy as np
+
+from ..Quantities import lru_cache
+from ..Instrumentation import timed
+
+_missing = frozenset(['-0', '-', ''])
+
+
+@lru_cache(maxsize=256)
+def _column_kinds(key):
+    # True for the text columns of a parsed stimuli key (trace, channel, name, unit, index)
+    return tuple(len(k) > 3 and k[3] == '-' for k in key)
+
+
+def _split_cells(lines, ncols):
+    # the cells of all rows split at double spaces like StimuliFile and the number of columns;
+    # short rows are padded with empty cells. Line ends are marked with a null cell, so that all
+    # rows are split at once and only checked for their length.
+    cells = list(filter(None, map(str.strip, ''.join(lines).replace('\n', '  \0  ').split('  '))))
+    if len(cells) == (ncols + 1) * len(lines) and cells[ncols::ncols + 1].count('\0') == len(lines):
+        del cells[ncols::ncols + 1]
+        return cells, ncols
+    rows = [[e.strip() for e in line.split('  ') if e.strip()] for line in lines]
+    ncols = max([ncols] + [len(r) for r in rows])
+    return [c for r in rows for c in r + [''] * (ncols - len(r))], ncols
+
+
+def _decode_column(cells, text):
+    # values (or codes), levels of text columns, and the mask of the missing cells or None
+    if not text:
+        values, missing = cells, None
+        if not _missing.isdisjoint(cells):
+            missing = np.array([c in _missing for c in cells], dtype=bool)
+            values = ['0' if m else c for c, m in zip(cells, missing)]
+        for dtype in (np.int64, np.float64):
+            try:
+                return np.array(values, dtype=dtype), None, missing
+            except ValueError:
+                pass
+    levels, codes = np.unique(np.array(cells, dtype=str), return_inverse=True)
+    codes = codes.ravel().astype(np.int32)
+    # empty cells sort first
+    return codes, levels, codes == 0 if len(levels) > 0 and levels[0] == '' else None
+
+
+@timed('StimuliTable.decode_stimuli_block')
+def decode_stimuli_block(lines, key):
+    """
+    Converts the lines of a stimuli.dat data block into a :class:`StimuliTable`. Numeric columns
+    become int64 arrays if all their cells are integers and float64 arrays otherwise; numeric
+    columns with cells that are no numbers are treated as text.
+
+    :param lines: lines of the data block
+    :param key: parsed stimuli key, see :func:`pyrelacs.DataClasses.KeyLoaders.parse_stimuli_key`
+    :returns: StimuliTable
+    """
+    lines = [l for l in lines if l.strip()]
+    key = tuple(key) if key is not None else ()
+    cells, ncols = _split_cells(lines, len(key))
+    kinds = _column_kinds(key) + (False,) * (ncols - len(key))
+    columns, levels, masks = [], [], []
+    for i in range(ncols):
+        x, level, mask = _decode_column(cells[i::ncols], kinds[i])
+        columns.append(x)
+        levels.append(level)
+        masks.append(mask)
+    return StimuliTable(key, columns, levels, masks)
+
+
+class StimuliTable(object):
+    """
+    Trials of a stimuli.dat block as typed columns.
+
+    :param key: parsed stimuli key with one entry (trace, channel, name, unit, index) per column
+    :param columns: list with one array per column; text columns hold int32 codes into their levels
+    :param levels: list with the array of distinct strings of each text column, None for numeric columns
+    :param masks: list with a boolean array marking the '-0' and missing cells of each column, or None
+    """
+
+    def __init__(self, key, columns, levels, masks):
+        self.key = key
+        self.columns = columns
+        self.levels = levels
+        self.masks = masks
+
+    def __len__(self):
+        return len(self.columns[0]) if len(self.columns) > 0 else 0
+
+    def __repr__(self):
+        return "StimuliTable with %i trials and columns %s" % (len(self), ", ".join(self.names))
+
+    @property
+    def names(self):
+        return [k[2] if len(k) > 2 else 'c%i' % i for i, k in
+                enumerate(list(self.key) + [()] * (len(self.columns) - len(self.key)))]
+
+    def _index(self, column):
+        if isinstance(column, int):
+            return column
+        if isinstance(column, tuple):
+            found = [i for i, k in enumerate(self.key) if tuple(k[:len(column)]) == column]
+        else:
+            found = [i for i, name in enumerate(self.names) if name == column]
+        if len(found) != 1:
+            raise KeyError("Column %s is %s!" % (column, 'not unique' if found else 'not in the key'))
+        return found[0]
+
+    def column(self, column):
+        """
+        Returns the values of a column, masked where cells are '-0' or missing.
+
+        :param column: index of the column, its name (e.g. 'signal'), or the beginning of its key
+                       entry (e.g. ('traces', 'V-1'))
+        :returns: array (text columns are decoded to strings) or masked array
+        """
+        i = self._index(column)
+        x = self.columns[i] if self.levels[i] is None else self.levels[i][self.columns[i]]
+        return x if self.masks[i] is None else np.ma.masked_array(x, self.masks[i])
+
+    def to_list(self):
+        """
+        Returns the trials as a list of rows with Python numbers and strings like the lists of
+        StimuliFile without columnar. Masked cells are None.
+        """
+        cols = []
+        for i in range(len(self.columns)):
+            values = (self.columns[i] if self.levels[i] is None else self.levels[i][self.columns[i]]).tolist()
+            if self.masks[i] is not None:
+                values = [None if m else v for v, m in zip(values, self.masks[i])]
+            cols.append(values)
+        return [list(row) for row in zip(*cols)]
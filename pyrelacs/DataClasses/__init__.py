@@ -1,21 +1,34 @@
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import os
 import re
+import time
 from .RelacsFile import SpikeFile, BeatFile, StimuliFile, FICurveFile, RelacsFile, TraceFile, read_info_file
+from .MetaIndex import Range
+from .BlockCache import BlockCache
+from .StimuliTable import StimuliTable
 
 
-def load(filename):
+def load(filename, cache=None):
+    """
+    Loads a relacs file with the class matching its name (info files are returned as a list of dictionaries).
+
+    :param filename: name of the relacs file
+    :param cache: :class:`BlockCache` the loaded blocks are kept in (default: an unlimited cache per file)
+    """
     if re.match(".*info.*\.dat$", filename):
         return read_info_file(filename)
     elif re.match(".*stimspikes.*\.dat$", filename) or re.match(".*samallspikes.*\.dat$", filename):
-        return SpikeFile(filename)
+        return SpikeFile(filename, cache=cache)
     elif re.match(".*ficurve-spikes.*\.dat$", filename) or re.match(".*stimulus-whitenoise-spikes.*\.dat$", filename) \
             or re.match(".*saveevents.*\.dat$", filename) or re.match(".*basespikes.*\.dat$", filename):
-        return SpikeFile(filename, mergetrials=False)
+        return SpikeFile(filename, mergetrials=False, cache=cache)
     elif re.match(".*beats-eod.*\.dat$", filename):
-        return BeatFile(filename)
+        return BeatFile(filename, cache)
     elif re.match(".*stimuli.*\.dat$", filename):
-        return StimuliFile(filename)
+        return StimuliFile(filename, cache)
     elif re.match(".*ficurves.*\.dat$", filename):
-        return FICurveFile(filename)
+        return FICurveFile(filename, cache)
     elif re.match(".*ficurve-.*\.dat$", filename) or re.match(".*vicurve-.*\.dat$", filename) \
             or re.match(".*transferfunction-data.*\.dat$", filename) \
             or re.match(".*stimulus-whitenoise-trace.*\.dat$", filename) \
@@ -24,6 +37,42 @@ def load(filename):
             or re.match(".*Whitenoise.*\.dat$", filename) \
             or re.match(".*baserate.*\.dat$", filename) \
             or re.match(".*baseisih.*\.dat$", filename):
-        return TraceFile(filename)
+        return TraceFile(filename, cache)
     else:
-        return RelacsFile(filename)
+        return RelacsFile(filename, cache)
+
+
+def _timed_load(filename):
+    start = time.time()
+    ret = load(filename)
+    return filename, ret, time.time() - start
+
+
+def load_directory(basedir, workers=None, pattern='*.dat', executor=None):
+    """
+    Loads all relacs files of a recording directory (stimuli.dat, spike files, ficurves, info.dat, ...)
+    in parallel. Every file is parsed with :func:`load` in a separate process.
+
+    :param basedir: directory of the recording (e.g. 2014-06-06-aa)
+    :param workers: number of worker processes (default: number of CPUs). With workers=1 the files are loaded serially.
+    :param pattern: glob pattern selecting the files of the recording
+    :param executor: an existing concurrent.futures executor to submit the files to (e.g. to share one pool between many directories)
+    :returns: a dictionary mapping file names to the loaded objects and a dictionary mapping file names to the loading time in seconds
+
+    >>> files, timing = load_directory('2014-06-06-aa', workers=8)
+    >>> spikes = files['stimspikes1.dat']
+    """
+    filenames = sorted(glob.glob(os.path.join(basedir, pattern)))
+    if executor is not None:
+        results = executor.map(_timed_load, filenames)
+    elif workers == 1:
+        results = map(_timed_load, filenames)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_timed_load, filenames))
+
+    files, timing = {}, {}
+    for filename, obj, duration in results:
+        files[os.path.basename(filename)] = obj
+        timing[os.path.basename(filename)] = duration
+    return files, timing
@@ -1,15 +1,28 @@
+import os
 from os import path
 try:
     from itertools import izip
 except:
     izip = zip
 import types
-from numpy import array, arange, NaN, fromfile, float32, asarray, unique, squeeze, Inf, isnan, fromstring, max
+from numpy import array, arange, NaN, fromfile, float32, asarray, unique, squeeze, Inf, isnan, fromstring, max, \
+    signbit, flatnonzero, empty, concatenate, zeros, minimum, maximum, full, int64, int32, where
 from numpy.core.records import fromarrays
 #import nixio as nix
-import re
 import warnings
-import gzip
+from .GzipIndex import open_gzip
+from .Quantities import parse_quantity
+from . import Instrumentation
+from .Instrumentation import timed
+from .SpikeTrains import RaggedSpikes
+from .RawTraces import RawTrace, load_raw_traces, raw_trace_filename
+import json
+from collections import namedtuple
+
+INDEX_VERSION = 1
+
+# number of trials that load_trace_epochs gathers at once
+TRIAL_BATCH = 64
 
 identifiers = {
     'stimspikes1.dat': lambda info: ('RePro' in info[-1] and info[-1]['RePro'] == 'FileStimulus'),
@@ -37,40 +50,62 @@ def iload_io_pairs(basedir, spikefile, traces, filterfunc=None):
     (see iload and iload trace_trials) from all traces and spike times and has to return True is the block is wanted
      and False otherwise.
 
+     stimuli.dat is parsed only once and the trial windows are cut from all requested traces. If several
+     spike files are given, their blocks are returned in the order of stimuli.dat.
+
      :param basedir: basis directory of the recordings (e.g. 2014-06-06-aa)
-     :param spikefile: spikefile (e.g. stimspikes1.dat)
+     :param spikefile: spikefile (e.g. stimspikes1.dat) or a list of spikefiles
      :param traces: trace numbers as a list (e.g. [1,2])
      :param filterfunc: function that gets the infos from all traces and spike times and indicates whether the block is wanted or not
     """
 
-    if filterfunc is None: filterfunc = lambda inp: True
+    if filterfunc is None: filterfunc = lambda *infos: True
 
-    if type(traces) is not types.ListType:
+    if not isinstance(traces, (list, tuple)):
         traces = [traces]
+    spikefiles = spikefile if isinstance(spikefile, (list, tuple)) else [spikefile]
 
-    assert spikefile in identifiers, """iload_io_pairs does not know how to identify trials in stimuli.dat which
+    for spikefile in spikefiles:
+        assert spikefile in identifiers, """iload_io_pairs does not know how to identify trials in stimuli.dat which
                                         correspond to trials in {0}. Please update pyRELACS.DataLoader.identifiers
                                         accordingly""".format(spikefile)
-    iterators = [info_filter(iload_trace_trials(basedir, tn), identifiers[spikefile]) for tn in traces] \
-                + [iload_spike_blocks(basedir + '/' + spikefile)]
+    spikes = dict((spikefile, iload_spike_blocks(basedir + '/' + spikefile)) for spikefile in spikefiles)
+    raw = dict((tn, RawTrace(raw_trace_filename(basedir, tn))) for tn in set(traces))
 
-    for stuff in izip(*iterators):
-        info, key, dat = zip(*stuff)
-        if filterfunc(*info):
-            yield info, key, dat
+    for info, key, dat in iload('%s/stimuli.dat' % (basedir,)):
+        for spikefile in spikefiles:
+            if spikefile not in spikes or not identifiers[spikefile](info):
+                continue
+            try:
+                spike_info, spike_key, spike_dat = next(spikes[spikefile])
+            except StopIteration:
+                del spikes[spikefile]
+                continue
+            data = tuple(_trial_windows(info, key, dat, raw[tn], tn) for tn in traces) + (spike_dat,)
+            infos = len(traces) * (info,) + (spike_info,)
+            if filterfunc(*infos):
+                yield infos, len(traces) * (key,) + (spike_key,), data
+        if len(spikes) == 0:
+            break
 
-def iload_spike_blocks(filename):
+@timed('DataLoader.iload_spike_blocks')
+def iload_spike_blocks(filename, ragged=False):
     """
     Loades spike times from filename and merges trials with incremental trial numbers into one block.
     Spike times are assumed to be in seconds and are converted into ms.
+
+    ragged: bool
+        If True, merged trials are returned as a :class:`pyrelacs.SpikeTrains.RaggedSpikes`
+        object instead of a list of arrays.
     """
+    merged = RaggedSpikes.from_trials if ragged else list
     current_trial = -1
     ret_dat = []
     old_info = old_key = None
     for info, key, dat in iload(filename):
         if 'trial' in info[-1]:
             if int(info[-1]['trial']) != current_trial + 1:
-                yield old_info[:-1], key, ret_dat
+                yield old_info[:-1], key, merged(ret_dat)
                 ret_dat = []
 
             current_trial = int(info[-1]['trial'])
@@ -82,65 +117,66 @@ def iload_spike_blocks(filename):
 
         else:
             if len(ret_dat) > 0:
-                yield old_info[:-1], old_key, ret_dat
+                yield old_info[:-1], old_key, merged(ret_dat)
                 ret_dat = []
             yield info, key, dat
     else:
         if len(ret_dat) > 0:
-            yield old_info[:-1], old_key, ret_dat
+            yield old_info[:-1], old_key, merged(ret_dat)
 
 
 
 
 
-def iload_trace_trials(basedir, trace_no=1, before=0.0, after=0.0 ):
-    """
-    returns:
-    info : metadata from stimuli.dat
-    key : key from stimuli.dat
-    data : the data of the specified trace of all trials
-    """
-    x = fromfile('%s/trace-%i.raw' % (basedir, trace_no), float32)
-    p = re.compile('([-+]?\d*\.\d+|\d+)\s*(\w+)')
+def _trial_windows(info, key, dat, trace, trace_no, before=0.0, after=0.0):
+    # cuts the trials of one stimuli.dat block from the trace
+    X = []
+    val = parse_quantity(info[-1]['duration'])[0]
+    duration_index = key[2].index('duration')
 
-    for info, key, dat in iload('%s/stimuli.dat' % (basedir,)):
-        X = []
-        val, unit = p.match(info[-1]['duration']).groups()
-        val = float( val )
-        if unit == 'ms' :
-            val *= 0.001
-        duration_index = key[2].index('duration')
-
-        sval, sunit = p.match(info[0]['sample interval%i' % trace_no]).groups()
-        sval = float( sval )
-        if sunit == 'ms' :
-            sval *= 0.001
-
-        l = int(before / sval)
-        r = int((val+after) / sval)
-
-        if dat.shape == (1,1) and dat[0,0] == 0:
-            warnings.warn("iload_trace_trials: Encountered incomplete '-0' trial.")
-            yield info, key, array([])
+    sval = parse_quantity(info[0]['sample interval%i' % trace_no])[0]
+
+    l = int(before / sval)
+    r = int((val+after) / sval)
+
+    if dat.shape == (1,1) and dat[0,0] == 0:
+        warnings.warn("iload_trace_trials: Encountered incomplete '-0' trial.")
+        return array([])
+
+
+    for col, duration in zip(asarray([e[trace_no - 1] for e in dat], dtype=int), asarray([e[duration_index] for e in dat], dtype=float32)):  #dat[:,trace_no-1].astype(int):
+        tmp = trace.window(col - l, col + r)
+
+        if duration < 0.001: # if the duration is less than 1ms
+            warnings.warn("iload_trace_trials: Skipping one trial because its duration is <1ms and therefore it is probably rubbish")
             continue
 
+        if len(X) > 0 and len(tmp) != len(X[0]):
+            warnings.warn("iload_trace_trials: Setting one trial to NaN because it appears to be incomplete!")
+            X.append(NaN*X[0])
+        else:
+            X.append(tmp)
 
-        for col, duration in zip(asarray([e[trace_no - 1] for e in dat], dtype=int), asarray([e[duration_index] for e in dat], dtype=float32)):  #dat[:,trace_no-1].astype(int):
-            tmp = x[col-l:col + r]
+    return asarray(X)
 
-            if duration < 0.001: # if the duration is less than 1ms
-                warnings.warn("iload_trace_trials: Skipping one trial because its duration is <1ms and therefore it is probably rubbish")
-                continue
 
-            if len(X) > 0 and len(tmp) != len(X[0]):
-                warnings.warn("iload_trace_trials: Setting one trial to NaN because it appears to be incomplete!")
-                X.append(NaN*X[0])
-            else:
-                X.append(tmp)
+@timed('DataLoader.iload_trace_trials')
+def iload_trace_trials(basedir, trace_no=1, before=0.0, after=0.0, blocks=None ):
+    """
+    blocks : indices of the stimuli.dat blocks to load (see iload), all blocks if None
+
+    returns:
+    info : metadata from stimuli.dat
+    key : key from stimuli.dat
+    data : the data of the specified trace of all trials
+    """
+    trace = RawTrace(raw_trace_filename(basedir, trace_no))
 
-        yield info, key, asarray(X)
+    for info, key, dat in iload('%s/stimuli.dat' % (basedir,), blocks=blocks):
+        yield info, key, _trial_windows(info, key, dat, trace, trace_no, before, after)
 
 
+@timed('DataLoader.iload_traces')
 def iload_traces(basedir, repro='', before=0.0, after=0.0 ):
     """
     returns:
@@ -149,27 +185,22 @@ def iload_traces(basedir, repro='', before=0.0, after=0.0 ):
     time : an array for the time axis
     data : the data of all traces of a single trial 
     """
-    p = re.compile('([-+]?\d*\.\d+|\d+)\s*(\w+)')
     reproid = 'RePro'
     deltat = None
 
-    # open traces files:
-    sf = []
-    for trace in range(1, 1000000) :
-        if path.isfile( '%s/trace-%i.raw' % (basedir, trace) ) :
-            sf.append( open( '%s/trace-%i.raw' % (basedir, trace), 'rb' ) )
-        else :
-            break
+    # memory map traces files:
+    sf = load_raw_traces(basedir)
 
     basecols = None
     baserp = True
 
-    for info, key, dat in iload('%s/stimuli.dat' % basedir, False):
+    blocks = None
+    if len(repro) > 0:
+        blocks = repro_blocks(load_index('%s/stimuli.dat' % basedir), repro)
+
+    for info, key, dat in iload('%s/stimuli.dat' % basedir, False, blocks=blocks):
         if deltat is None:
-            deltat, tunit = p.match(info[0]['sample interval%i' % 1]).groups()
-            deltat = float( deltat )
-            if tunit == 'ms' :
-                deltat *= 0.001
+            deltat = parse_quantity(info[0]['sample interval%i' % 1])[0]
                 
         if 'repro' in info[-1] or 'RePro' in info[-1]:
             if not reproid in info[-1]:
@@ -201,9 +232,7 @@ def iload_traces(basedir, repro='', before=0.0, after=0.0 ):
                 xl = []
                 for trace in range(len(sf)) :
                     col = int(d[trace])
-                    sf[trace].seek( basecols[trace]*4 )
-                    buffer = sf[trace].read( (col - basecols[trace])*4 )
-                    tmp = fromstring(buffer, float32)
+                    tmp = sf[trace].window(basecols[trace], col)
                     x.append(tmp)
                     xl.append(len(tmp))
                 ml = min(xl)
@@ -237,9 +266,7 @@ def iload_traces(basedir, repro='', before=0.0, after=0.0 ):
                         col = 0
                     basecols.append(col)
                     continue
-                sf[trace].seek( (col-l)*4 )
-                buffer = sf[trace].read( (l+r)*4 )
-                tmp = fromstring(buffer, float32)
+                tmp = sf[trace].window(col - l, col + r)
                 x.append(tmp)
                 xl.append(len(tmp))
             if baserp:
@@ -257,117 +284,641 @@ def iload_traces(basedir, repro='', before=0.0, after=0.0 ):
         sf[trace].close()
 
 
-def iload(filename, return_array=True):
+def _select_trials(stimuli, ntraces, repro=None, filterfunc=None, duration=None):
+    # start indices (trials x traces) and durations of the trials of stimuli.dat selected
+    # by repro and filterfunc, see load_trace_epochs
+    def selected(info):
+        if len(info) == 0:
+            return False
+        reproid = 'RePro' if 'RePro' in info[-1] else 'repro'
+        if repro is not None and info[-1].get(reproid) != repro:
+            return False
+        return filterfunc is None or filterfunc(info)
+
+    index = load_index(stimuli)
+    blocks = [i for i, entry in enumerate(index) if selected(entry.meta)]
+
+    deltat = None
+    starts = []
+    durations = []
+    infos = []
+    for info, key, dat in iload(stimuli, blocks=blocks):
+        if deltat is None:
+            deltat = parse_quantity(info[0]['sample interval%i' % 1])[0]
+        if dat.ndim < 2 or dat.shape[1] < ntraces or (dat.shape == (1, 1) and dat[0, 0] == 0):
+            warnings.warn("load_trace_epochs: Encountered incomplete '-0' trial.")
+            continue
+        if duration is None:
+            duration_indices = [i for i, x in enumerate(key[2]) if x == 'duration'] if len(key) > 2 else []
+            if len(duration_indices) == 0:
+                continue
+            scale = array([0.001 if len(key) > 3 and key[3][i] == 'ms' else 1.0 for i in duration_indices])
+            d = (dat[:, duration_indices] * scale).max(axis=1)
+        else:
+            d = full(len(dat), duration)
+        valid = d >= 0.001  # shorter trials are probably rubbish
+        if not valid.all():
+            warnings.warn("load_trace_epochs: Skipping %d trials because their duration is <1ms" % (len(d) - valid.sum(),))
+        starts.append(dat[valid, :ntraces].astype(int))
+        durations.append(d[valid])
+        infos.extend([info] * valid.sum())
+
+    starts = concatenate(starts) if len(starts) > 0 else empty((0, ntraces), dtype=int)
+    durations = concatenate(durations) if len(durations) > 0 else empty(0)
+    return deltat, starts, durations, infos
+
+
+@timed('DataLoader.load_trace_epochs')
+def load_trace_epochs(basedir, repro=None, filterfunc=None, before=0.0, after=0.0, duration=None):
     """
-    return_array: bool
-        If True return data of the table as numpy array,
-        otherwise as tuple (that preserves numbers and strings).
+    Loads the data of all traces around all matching trials of stimuli.dat into a single array.
+
+    The trials are selected by the name of the RePro and/or by filterfunc, which gets the
+    metadata of a stimuli.dat block (like in :func:`info_filter`). The window of a trial runs from
+    before seconds before the trial start to after seconds after the end of the stimulus. Trials
+    with shorter stimuli or at the start or end of the recording are shorter than the window; the
+    valid samples of trial i are data[i, :, offsets[i]:offsets[i] + lengths[i]] and the remaining
+    samples are zero.
+
+    :param basedir: directory of the recording
+    :param repro: name of the RePro
+    :param filterfunc: function that returns True for the metadata of the blocks to be loaded
+    :param before: time before the trial start in seconds
+    :param after: time after the stimulus end in seconds
+    :param duration: duration of all trials in seconds, taken from the duration columns of stimuli.dat if None
+    :returns: time (samples), data (trials x traces x samples), offsets (trials), lengths (trials), infos (metadata of each trial)
     """
-    meta_data = []
-    new_meta_data = []
-    same_new_meta_data = 0
-    key = []
+    sf = load_raw_traces(basedir)
+    deltat, starts, durations, infos = _select_trials('%s/stimuli.dat' % basedir, len(sf), repro, filterfunc, duration)
+
+    l = int(before / deltat) if deltat is not None else 0
+    starts = starts - l
+    lengths = l + (durations + after) / deltat if len(durations) > 0 else empty(0)
+    lengths = lengths.astype(int)
+    n = lengths.max() if len(lengths) > 0 else 0
+    time = arange(0.0, n) * (deltat if deltat is not None else 0.0) - before
+
+    # the samples of a trial that all traces recorded, leading samples before the start of a recording are skipped
+    offsets = zeros(len(starts), dtype=int)
+    ends = lengths
+    for trace in range(len(sf)):
+        offsets = maximum(offsets, -starts[:, trace])
+        ends = minimum(ends, len(sf[trace]) - starts[:, trace])
+    ends = maximum(ends, offsets)
+
+    # the trials are gathered TRIAL_BATCH at a time, so the index arrays stay small for many trials
+    data = zeros((len(starts), len(sf), n), dtype=float32)
+    samples = arange(n)
+    for i in range(0, len(starts), TRIAL_BATCH):
+        batch = slice(i, i + TRIAL_BATCH)
+        valid = (samples >= offsets[batch, None]) & (samples < ends[batch, None])
+        for trace in range(len(sf)):
+            x = sf[trace].data
+            if len(x) == 0:
+                continue
+            idx = (starts[batch, trace, None] + samples).clip(0, len(x) - 1)
+            data[batch, trace] = where(valid, x[idx], 0.0)
+    for trace in sf:
+        trace.close()
+    return time, data, offsets, ends - offsets, infos
 
-    within_key = within_meta_block = within_data_block = False
-    currkey = None
-    data = []
 
-    with open_any(filename, 'rt') as fid:
-        for line in fid:
+class DataReader(object):
+    """
+    Reads a relacs data file line by line, but hands out the lines of a data block all at once.
+    Works on files opened in binary mode.
 
-            line = line.strip()
+    :param fid: file object opened in binary mode
+    :param chunksize: number of bytes that are read at once
+    """
 
-            if within_data_block and (line.startswith('#') or not line):
-                within_data_block = False
+    def __init__(self, fid, chunksize=1 << 22):
+        self.fid = fid
+        self.chunksize = chunksize
+        self.buffer = b''
+        self.pos = 0
+        self.offset = 0  # file offset of the buffer start
+
+    def _fill(self):
+        # the byte before the current position is kept, so that every line start is preceded by a newline
+        chunk = self.fid.read(self.chunksize)
+        if not chunk:
+            return False
+        if Instrumentation.enabled:
+            Instrumentation.count('DataLoader.bytes read', len(chunk))
+        keep = self.pos - 1 if self.pos > 0 else 0
+        self.buffer = self.buffer[keep:] + chunk
+        self.pos -= keep
+        self.offset += keep
+        return True
 
-                if return_array:
-                    yield list(meta_data), tuple(key), array(data)
-                else:
-                    yield list(meta_data), tuple(key), data
-                data = []
+    def tell(self):
+        """
+        Returns the file offset of the next line.
+        """
+        return self.offset + self.pos
+
+    def readline(self):
+        """
+        Returns the next line including its line break, or None at the end of the file.
+        """
+        end = self.buffer.find(b'\n', self.pos)
+        while end < 0:
+            searched = len(self.buffer) - self.pos
+            if not self._fill():
+                line = self.buffer[self.pos:]
+                self.pos = len(self.buffer)
+                return line if line else None
+            end = self.buffer.find(b'\n', self.pos + searched)
+        line = self.buffer[self.pos:end + 1]
+        self.pos = end + 1
+        if Instrumentation.enabled:
+            Instrumentation.count('DataLoader.lines read')
+        return line
+
+    def _data_end(self, start, stop):
+        # usually data blocks are ended by an empty line or a line starting with '#'
+        ends = [e for e in (self.buffer.find(b'\n#', start, stop), self.buffer.find(b'\n\n', start, stop)) if e >= 0]
+        end = min(ends) + 1 if ends else stop
+        region = self.buffer[start:end]
+        # ... but lines with whitespace only or indented comments end them as well
+        if b'#' in region or b'\n\n' in region.translate(None, b' \t\r\f\v'):
+            offset = start + 1
+            for line in region[1:-1].split(b'\n'):
+                stripped = line.strip()
+                if not stripped or stripped.startswith(b'#'):
+                    return offset
+                offset += len(line) + 1
+        return end if ends else None
+
+    def readdata(self):
+        """
+        Reads all lines up to the next empty line or line starting with '#'. The
+        terminating line is not consumed. Has to be called right after :meth:`readline`.
+
+        :returns: the lines as a single bytes object
+        """
+        pieces = []
+        while True:
+            stop = self.buffer.rfind(b'\n', self.pos) + 1  # only complete lines
+            if stop > self.pos:
+                end = self._data_end(self.pos - 1, stop)
+                if end is not None:
+                    pieces.append(self.buffer[self.pos:end])
+                    self.pos = end
+                    break
+                pieces.append(self.buffer[self.pos:stop])
+                self.pos = stop
+            if not self._fill():
+                line = self.buffer[self.pos:].strip()
+                if line and not line.startswith(b'#'):
+                    pieces.append(self.buffer[self.pos:])
+                    self.pos = len(self.buffer)
+                break
+        if Instrumentation.enabled:
+            Instrumentation.count('DataLoader.lines read', sum(p.count(b'\n') for p in pieces))
+        return b''.join(pieces)
 
-            # Key parsing
-            if line.startswith('#Key'):
-                key = []
-                within_key = True
-                continue
-            if within_key:
-                if not line.startswith('#'):
-                    within_key = False
-                else:
 
-                    key.append(tuple([e.strip() for e in line[1:].split("  ") if len(e.strip()) > 0]))
-                    continue
+def _mask_negative_zeros(x, cells):
+    # only negative zeros can stem from a '-0' cell
+    zeros = flatnonzero((x == 0) & signbit(x))
+    if len(zeros) > 0:
+        x[[i for i in zeros if cells[i] == b'-0']] = NaN
+    return x
 
-            # fast forward to first data point or meta data
-            if not line:
-                within_key = within_meta_block = False
-                currkey = None
-                continue
-            # meta data blocks
-            elif line.startswith('#'): # cannot be a key anymore
-                if not within_meta_block:
-                    within_meta_block = True
-                    new_meta_data.append({})
-                    same_new_meta_data = 0
-
-                if ':' in line:
-                    tmp = [e.strip() for e in line[1:].split(':')]
-                elif '=' in line:
-                    tmp = [e.strip() for e in line[1:].split('=')]
-                else:
-                    currkey = line[1:].strip()
-                    new_meta_data[-1][currkey] = {}
-                    continue
 
-                if currkey is None:
-                    new_meta_data[-1][tmp[0]] = tmp[1]
-                    if len(new_meta_data) > 1 and tmp[0] in new_meta_data[-2]:
-                        same_new_meta_data += 1
-                    # same meta data block without data inbetween:
-                    if same_new_meta_data > 2:
-                        n = len(new_meta_data) - 1
-                        meta_data[-n:] = new_meta_data[:-1]
-                        new_meta_data = [new_meta_data[-1]]
-                        same_new_meta_data = 0
-                        if return_array:
-                            yield list(meta_data), tuple(key), array([])
-                        else:
-                            yield list(meta_data), tuple(key), []
-                else:
-                    new_meta_data[-1][currkey][tmp[0]] = tmp[1]
+def _cells2float(cells):
+    try:
+        x = array(cells, dtype=float)
+    except ValueError:
+        if len(cells) > 256:
+            # non-numeric cells are usually rare, so narrow them down
+            half = len(cells) // 2
+            return concatenate((_cells2float(cells[:half]), _cells2float(cells[half:])))
+        values = dict((e, float(e) if (e != b'-0' and isfloat(e)) else NaN) for e in set(cells))
+        return array([values[e] for e in cells])
+    return _mask_negative_zeros(x, cells)
+
+
+@timed('DataLoader.parse_data_block')
+def parse_data_block(block):
+    """
+    Converts the lines of a data block into a 2D float array in a single NumPy pass.
+    Cells that are '-0' or not numeric become NaN.
+
+    :param block: the lines of the data block as a single bytes object
+    :returns: array with one row per line
+    """
+    block = block.strip()
+    rows = block.count(b'\n') + 1
+    cols = len(block[:block.find(b'\n')].split()) if rows > 1 else len(block.split())
+    cells = block.split()
+    if len(cells) != cols * rows or (cols > 1 and len(set(map(len, map(bytes.split, block.split(b'\n'))))) > 1):
+        # ragged block, cannot be converted in bulk
+        return array([[float(e) if (e != b'-0' and isfloat(e)) else NaN for e in line.split()]
+                      for line in block.split(b'\n')])
 
+    try:
+        x = _mask_negative_zeros(array(cells, dtype=float), cells)
+    except ValueError:
+        # non-numeric cells are usually confined to a few columns
+        x = empty((rows, cols))
+        for i in range(cols):
+            x[:, i] = _cells2float(cells[i::cols])
+    return x.reshape(rows, cols)
+
+
+class MetaParser(object):
+    """
+    State machine for the metadata and key lines of a relacs file. Collects the stack of
+    metadata blocks (meta_data) and the current key (key) line by line.
+    """
+
+    def __init__(self):
+        self.meta_data = []
+        self.new_meta_data = []
+        self.same_new_meta_data = 0
+        self.key = []
+        self.within_key = self.within_meta_block = False
+        self.currkey = None
+
+    def data(self):
+        """
+        Has to be called for the first line of a data block.
+        """
+        n = len(self.new_meta_data)
+        self.meta_data[-n:] = self.new_meta_data
+        self.new_meta_data = []
+        self.currkey = None
+        self.within_key = self.within_meta_block = False
+
+    def line(self, line):
+        """
+        Parses a stripped line that is not part of a data block.
+
+        :returns: True if the line completed a metadata block that has no data (an empty block)
+        """
+        # Key parsing
+        if line.startswith('#Key'):
+            self.key = []
+            self.within_key = True
+            return False
+        if self.within_key:
+            if not line.startswith('#'):
+                self.within_key = False
             else:
 
-                if not within_data_block:
-                    within_data_block = True
-                    n = len(new_meta_data)
-                    meta_data[-n:] = new_meta_data
-                    new_meta_data = []
-                    currkey = None
-                    within_key = within_meta_block = False
-                if return_array:
-                    data.append([float(e) if (e != '-0' and isfloat(e)) else NaN for e in line.split()])
-                else:
-                    data.append([float(e) if (e != '-0' and isfloat(e)) else e for e in line.split()])
-        else:  # if for loop is finished, return the data we have so far
-            if within_data_block and len(data) > 0:
-                if return_array:
-                    yield list(meta_data), tuple(key), array(data)
-                else:
-                    yield list(meta_data), tuple(key), data
+                self.key.append(tuple([e.strip() for e in line[1:].split("  ") if len(e.strip()) > 0]))
+                return False
+
+        # fast forward to first data point or meta data
+        if not line:
+            self.within_key = self.within_meta_block = False
+            self.currkey = None
+            return False
+        # meta data blocks
+        elif line.startswith('#'): # cannot be a key anymore
+            if not self.within_meta_block:
+                self.within_meta_block = True
+                self.new_meta_data.append({})
+                self.same_new_meta_data = 0
+
+            if ':' in line:
+                tmp = [e.strip() for e in line[1:].split(':')]
+            elif '=' in line:
+                tmp = [e.strip() for e in line[1:].split('=')]
+            else:
+                self.currkey = line[1:].strip()
+                self.new_meta_data[-1][self.currkey] = {}
+                return False
+
+            if self.currkey is None:
+                self.new_meta_data[-1][tmp[0]] = tmp[1]
+                if len(self.new_meta_data) > 1 and tmp[0] in self.new_meta_data[-2]:
+                    self.same_new_meta_data += 1
+                # same meta data block without data inbetween:
+                if self.same_new_meta_data > 2:
+                    n = len(self.new_meta_data) - 1
+                    self.meta_data[-n:] = self.new_meta_data[:-1]
+                    self.new_meta_data = [self.new_meta_data[-1]]
+                    self.same_new_meta_data = 0
+                    return True
+            else:
+                self.new_meta_data[-1][self.currkey][tmp[0]] = tmp[1]
+        return False
+
+
+@timed('DataLoader._scan_blocks')
+def _scan_blocks(fid):
+    """
+    Runs through a relacs file opened in binary mode and yields the metadata stack, the key, and
+    the raw data of every data block together with its position in the file
+    (byte offset, end offset, first line, end line).
+    """
+    parser = MetaParser()
+    reader = DataReader(fid)
+    line_no = 0
+    while True:
+        offset = reader.tell()
+        raw = reader.readline()
+        if raw is None:
+            break
+        line_no += 1
+        line = raw.decode(errors='replace').strip()
+
+        # data blocks are read as a whole
+        if line and not line.startswith('#'):
+            parser.data()
+            block = raw + reader.readdata()
+            start = line_no - 1
+            line_no = start + block.count(b'\n') + (not block.endswith(b'\n'))
+            yield list(parser.meta_data), tuple(parser.key), block, offset, reader.tell(), start, line_no
+            continue
+
+        if parser.line(line):
+            yield list(parser.meta_data), tuple(parser.key), b'', offset, offset, line_no - 1, line_no - 1
+
+
+BlockEntry = namedtuple('BlockEntry', ['meta', 'key', 'offset', 'end', 'start_line', 'end_line'])
+
+
+def index_filename(filename):
+    """
+    Returns the name of the sidecar file the block index of filename is stored in.
+    """
+    return filename + '.idx'
+
+
+@timed('DataLoader.build_index')
+def build_index(filename):
+    """
+    Runs once through a relacs data file and records the position of each block that
+    :func:`iload` would return.
+
+    :param filename: Filename of the data file.
+    :returns: list of BlockEntry namedtuples with the metadata stack, the key, the byte range, and the line range of each block.
+    """
+    with open_any(filename, 'rb') as fid:
+        return [BlockEntry(*block[:2] + block[3:]) for block in _scan_blocks(fid)]
+
+
+def _file_stamp(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+def save_index(filename, index):
+    """
+    Stores a block index next to filename. Metadata stacks and keys that are shared by several
+    blocks are only stored once.
+    """
+    metas, keys = [], []
+    meta_ids, key_ids = {}, {}
+    blocks = []
+    for entry in index:
+        levels = []
+        for level in entry.meta:
+            level = json.dumps(level)
+            if level not in meta_ids:
+                meta_ids[level] = len(metas)
+                metas.append(level)
+            levels.append(meta_ids[level])
+        if entry.key not in key_ids:
+            key_ids[entry.key] = len(keys)
+            keys.append(entry.key)
+        blocks.append((levels, key_ids[entry.key], entry.offset, entry.end, entry.start_line, entry.end_line))
+
+    size, mtime = _file_stamp(filename)
+    tmpname = index_filename(filename) + '.tmp'
+    with open(tmpname, 'w') as fid:
+        json.dump({'version': INDEX_VERSION, 'size': size, 'mtime': mtime,
+                   'metas': [json.loads(m) for m in metas], 'keys': keys, 'blocks': blocks}, fid)
+    os.replace(tmpname, index_filename(filename))
+
+
+@timed('DataLoader.load_index')
+def load_index(filename, rebuild=False):
+    """
+    Returns the block index of a relacs data file (see :func:`build_index`). The index is
+    read from the sidecar file next to filename. If it does not exist, or size or modification
+    time of filename changed, it is built and stored again.
+
+    :param filename: Filename of the data file.
+    :param rebuild: always build the index from scratch
+    :returns: list of BlockEntry namedtuples
+    """
+    idxname = index_filename(filename)
+    if not rebuild and path.isfile(idxname):
+        try:
+            with open(idxname, 'r') as fid:
+                stored = json.load(fid)
+        except ValueError:
+            stored = {}
+        if stored.get('version') == INDEX_VERSION and (stored['size'], stored['mtime']) == _file_stamp(filename):
+            if Instrumentation.enabled:
+                Instrumentation.count('DataLoader.index hits')
+            metas = stored['metas']
+            keys = [tuple(tuple(row) for row in key) for key in stored['keys']]
+            return [BlockEntry([metas[i] for i in levels], keys[key], offset, end, start_line, end_line)
+                    for levels, key, offset, end, start_line, end_line in stored['blocks']]
+
+    if Instrumentation.enabled:
+        Instrumentation.count('DataLoader.index misses')
+    index = build_index(filename)
+    try:
+        save_index(filename, index)
+    except (IOError, OSError) as e:
+        warnings.warn("Could not store block index for %s: %s" % (filename, e))
+    return index
+
+
+def repro_blocks(index, repro):
+    """
+    Returns the indices of the blocks in a stimuli.dat index that belong to the RePro repro.
+    Blocks without RePro information and the blocks directly following the selected ones
+    are included as well, since they mark the end of a baseline recording.
+
+    :param index: block index of a stimuli.dat file (see :func:`load_index`)
+    :param repro: name of the RePro
+    :returns: list of block indices
+    """
+    ret = []
+    previous = False
+    for i, entry in enumerate(index):
+        info = entry.meta[-1] if len(entry.meta) > 0 else {}
+        reproid = 'RePro' if 'RePro' in info else 'repro'
+        selected = reproid not in info or info[reproid] == repro
+        if selected or previous:
+            ret.append(i)
+        previous = selected
+    return ret
+
+
+@timed('DataLoader.iload')
+def iload(filename, return_array=True, blocks=None):
+    """
+    return_array: bool
+        If True return data of the table as numpy array,
+        otherwise as tuple (that preserves numbers and strings).
+    blocks: list of int
+        If given, only these blocks are returned. Their positions are taken from the
+        block index (see :func:`load_index`), so that each of them costs a single seek.
+    """
+    if blocks is None:
+        with open_any(filename, 'rb') as fid:
+            for meta, key, block, _, _, _, _ in _scan_blocks(fid):
+                yield meta, key, _convert_block(block, return_array)
+    else:
+        index = load_index(filename)
+        with open_any(filename, 'rb') as fid:
+            for i in blocks:
+                entry = index[i]
+                fid.seek(entry.offset)
+                block = fid.read(entry.end - entry.offset)
+                yield list(entry.meta), entry.key, _convert_block(block, return_array)
+
+
+def _convert_block(block, return_array):
+    if not block:
+        return array([]) if return_array else []
+    elif return_array:
+        return parse_data_block(block)
+    else:
+        return [[float(e) if (e != '-0' and isfloat(e)) else e for e in l.split()]
+                for l in block.decode(errors='replace').strip().split('\n')]
 
 
 def recload(filename):
+    """
+    Like :func:`iload`, but returns the data of each block as a record array with
+    the names in the first key row. See :func:`iload_records` for typed columns.
+    """
     for meta, key, dat in iload(filename):
         yield meta, fromarrays(dat.T, names=key[0])
 
 
+def _key_columns(key, cols):
+    # the names and types of the columns. In a relacs key the last row holds the units (or types
+    # like 'float' and 'int') and the row before it the names; a trailing row with the column
+    # numbers is skipped. Types are None if the key has no units.
+    rows = [row for row in key if len(row) > 0]
+    if len(rows) > 0 and list(rows[-1]) == [str(i + 1) for i in range(len(rows[-1]))]:
+        rows = rows[:-1]
+    if len(rows) > 1 and len(rows[-2]) == cols and len(rows[-1]) == cols:
+        names, units = list(rows[-2]), rows[-1]
+        types = ['text' if u == '-' else 'int' if u in ('int', 'uint') else 'float' for u in units]
+    else:
+        names = list(rows[-1]) if len(rows) > 0 and len(rows[-1]) == cols else ['c%i' % i for i in range(cols)]
+        types = [None] * cols
+    seen = {}
+    for i, name in enumerate(names):
+        if name in seen:
+            seen[name] += 1
+            names[i] = '%s_%i' % (name, seen[name])
+        else:
+            seen[name] = 1
+    return names, types
+
+
+def _typed_column(cells, type=None):
+    # the type is taken from the key, so that a column has the same type in all blocks;
+    # without a type it is inferred from the cells. '-0' marks missing values, which only
+    # a float column can hold
+    if type == 'text':
+        levels, codes = unique(cells, return_inverse=True)
+        return codes.ravel().astype(int32), array([l.decode(errors='replace') for l in levels])
+    if type == 'float':
+        return _cells2float(cells), None
+    if b'-0' not in cells:
+        try:
+            return array(cells, dtype=int64), None
+        except ValueError:
+            if type == 'int':
+                warnings.warn("iload_records: Integer column with other values is loaded as float.")
+                return _cells2float(cells), None
+    elif type == 'int':
+        warnings.warn("iload_records: Integer column with missing values is loaded as float.")
+        return _cells2float(cells), None
+    try:
+        return _mask_negative_zeros(array(cells, dtype=float), cells), None
+    except ValueError:
+        return _typed_column(cells, 'text')
+
+
+@timed('DataLoader.iload_records')
+def iload_records(filename, columns=None):
+    """
+    Loads the data blocks of a relacs file as structured arrays with one typed field per
+    column. The field names are taken from the names row of the key (the row before the
+    units) and the types from its units row, so a column has the same type in every block:
+    columns with the unit '-' are dictionary encoded (the field holds int32 codes into an
+    array of distinct strings, the levels), columns of type 'int' or 'uint' become int64, and
+    all other columns float64 (with '-0' and other non-numeric cells as NaN). For keys
+    without units, integer columns become int64, numeric columns float64, and all others
+    are dictionary encoded. Duplicate names get a suffix (e.g. 'index', 'index_2').
+
+    :param filename: Filename of the data file.
+    :param columns: names or indices of the columns to load, all columns if None
+    :returns: generator of metadata, key, structured array, and a dictionary with the levels of the string columns
+
+    >>> for meta, key, rec, levels in iload_records('stimuli.dat', columns=['index', 'signal']):
+    ...     signals = levels['signal'][rec['signal']]
+    """
+    with open_any(filename, 'rb') as fid:
+        for meta, key, block, _, _, _, _ in _scan_blocks(fid):
+            block = block.strip()
+            if not block:
+                yield meta, key, empty(0, dtype=[]), {}
+                continue
+            rows = block.count(b'\n') + 1
+            cols = len(block[:block.find(b'\n')].split()) if rows > 1 else len(block.split())
+            cells = block.split()
+            names, types = _key_columns(key, cols)
+            if columns is None:
+                selected = list(range(cols))
+            else:
+                selected = [c if isinstance(c, int) else names.index(c) if c in names else -1 for c in columns]
+                if any(c < 0 or c >= cols for c in selected):
+                    raise ValueError("Columns %s not found in %s" % (columns, names))
+
+            if len(cells) != cols * rows or \
+                    (cols > 1 and len(set(map(len, map(bytes.split, block.split(b'\n'))))) > 1):
+                warnings.warn("iload_records: Ragged data block is loaded as float.")
+                x = parse_data_block(block)
+                data = [(x[:, i], None) for i in selected]
+            else:
+                data = [_typed_column(cells[i::cols], types[i]) for i in selected]
+
+            rec = empty(rows, dtype=[(names[i], x.dtype) for i, (x, _) in zip(selected, data)])
+            levels = {}
+            for i, (x, level) in zip(selected, data):
+                rec[names[i]] = x
+                if level is not None:
+                    levels[names[i]] = level
+            yield meta, key, rec, levels
+
+
+def _load_data_block(block):
+    # like parse_data_block, but '-0' stays -0.0 and non-numeric cells raise a ValueError
+    lines = block.strip().split(b'\n')
+    cells = block.split()
+    cols = len(lines[0].split())
+    if b'---' not in block and len(cells) == cols * len(lines) and \
+            (cols == 1 or len(set(map(len, map(bytes.split, lines)))) == 1):
+        return array(cells, dtype=float).reshape(len(lines), cols)
+    return array([[float(e) for e in l.split()] for l in block.decode(errors='replace').strip().split('\n') if '---' not in l])
+
+
+@timed('DataLoader.load')
 def load(filename):
     """
     
     Loads a data file saved by relacs. Returns a tuple of dictionaries
     containing the data and the header information
+
+    The file is read incrementally and the data blocks are converted as a whole,
+    so only a single data block is held in memory as text.
     
     :param filename: Filename of the data file.
     :type filename: string
@@ -375,57 +926,61 @@ def load(filename):
     :rtype: tuple
 
     """
-    with open_any(filename, 'rt') as fid:
-        L = [l.lstrip().rstrip() for l in fid.readlines()]
-
     ret = []
     dat = {}
-    X = []
+    X = None
     keyon = False
     currkey = None
-    for l in L:
-        # if empty line and we have data recorded
-        if (not l or l.startswith('#')) and len(X) > 0:
-            keyon = False
-            currkey = None
-            dat['data'] = array(X)
-            ret.append(dat)
-            X = []
-            dat = {}
-
-        if '---' in l:
-            continue
-        if l.startswith('#'):
-            if ":" in l:
-                tmp = [e.rstrip().lstrip() for e in l[1:].split(':')]
-                if currkey is None:
-                    dat[tmp[0]] = tmp[1]
-                else:
-                    dat[currkey][tmp[0]] = tmp[1]
-            elif "=" in l:
-                tmp = [e.rstrip().lstrip() for e in l[1:].split('=')]
-                if currkey is None:
-                    dat[tmp[0]] = tmp[1]
-                else:
-                    dat[currkey][tmp[0]] = tmp[1]
-            elif l[1:].lower().startswith('key'):
-                dat['key'] = []
+    with open_any(filename, 'rb') as fid:
+        reader = DataReader(fid)
+        while True:
+            l = reader.readline()
+            if l is None:
+                break
+            l = l.decode(errors='replace').strip()
 
-                keyon = True
-            elif keyon:
+            # if empty line and we have data recorded
+            if (not l or l.startswith('#')) and X is not None:
+                keyon = False
+                currkey = None
+                dat['data'] = X
+                ret.append(dat)
+                X = None
+                dat = {}
 
-                dat['key'].append(tuple([e.lstrip().rstrip() for e in l[1:].split()]))
-            else:
-                currkey = l[1:].rstrip().lstrip()
-                dat[currkey] = {}
+            if '---' in l:
+                continue
+            if l.startswith('#'):
+                if ":" in l:
+                    tmp = [e.rstrip().lstrip() for e in l[1:].split(':')]
+                    if currkey is None:
+                        dat[tmp[0]] = tmp[1]
+                    else:
+                        dat[currkey][tmp[0]] = tmp[1]
+                elif "=" in l:
+                    tmp = [e.rstrip().lstrip() for e in l[1:].split('=')]
+                    if currkey is None:
+                        dat[tmp[0]] = tmp[1]
+                    else:
+                        dat[currkey][tmp[0]] = tmp[1]
+                elif l[1:].lower().startswith('key'):
+                    dat['key'] = []
+
+                    keyon = True
+                elif keyon:
+
+                    dat['key'].append(tuple([e.lstrip().rstrip() for e in l[1:].split()]))
+                else:
+                    currkey = l[1:].rstrip().lstrip()
+                    dat[currkey] = {}
 
-        elif l:  # if l != ''
-            keyon = False
-            currkey = None
-            X.append([float(e) for e in l.split()])
+            elif l:  # if l != ''
+                keyon = False
+                currkey = None
+                X = _load_data_block(l.encode() + b'\n' + reader.readdata())
 
-    if len(X) > 0:
-        dat['data'] = array(X)
+    if X is not None:
+        dat['data'] = X
     else:
         dat['data'] = []
     ret.append(dat)
@@ -440,13 +995,15 @@ def open_any(filename, mode = 'rt'):
     
     :param filename: Filename of the data file.
     :param mode: mode in which the file will be opened. default: read-only,text-mode (important for .gz)
+                 .gz files opened with 'rb' support fast seeking, see :mod:`pyrelacs.GzipIndex`
     :type filename: string
     :returns:  a file containing the data to be read
     :rtype: file
     '''
     
     if filename.endswith(".gz"):
-        return gzip.open(filename, mode)
+        # binary reads are seekable if indexed_gzip is installed
+        return open_gzip(filename, mode)
     else:
         return open(filename, mode)
 
@@ -0,0 +1,172 @@
+"""
+PSTHs, kernel firing rates, spike counts and interspike interval histograms of many trials.
+
+The functions take the merged trials of a :class:`pyrelacs.DataClasses.RelacsFile.SpikeFile`
+or :func:`pyrelacs.DataLoader.iload_spike_blocks` either as a single run (a
+:class:`pyrelacs.SpikeTrains.RaggedSpikes` object or a list of spike time arrays) or as a list
+of runs (e.g. the data of all selected SAM blocks). All trials of all runs are processed at
+once; results of a list of runs have one row per run.
+
+The functions are unit-agnostic: all times (spike times, bins, time axes, kernel widths, and
+windows) must be in the same unit, and rates are returned in events per that unit. Relacs spike files store milliseconds,
+so convert them to seconds to get rates in Hertz:
+
+>>> spikes = load('2014-06-06-aa/stimspikes1.dat')
+>>> _, _, runs = spikes.select({'RePro': 'SAM'})
+>>> runs = [[trial * 1e-3 for trial in run] for run in runs]  # ms -> s
+>>> time = np.arange(0.0, 1.0, 0.0005)
+>>> rates = kernel_rate(runs, time, 'gauss', 0.002)  # runs x time
+"""
+import numpy as np
+
+from .SpikeTrains import RaggedSpikes
+
+DIRECT_TAPS = 64  # kernels with more samples are convolved via FFT
+
+
+def _is_trial(x):
+    # a trial is an array of spike times (or a single spike time), lists are runs of trials
+    return not isinstance(x, (list, tuple, RaggedSpikes)) and np.ndim(x) <= 1
+
+
+def _as_runs(spikes):
+    # returns all trials as one RaggedSpikes object, the number of trials of each run, and
+    # whether a single run was given
+    if isinstance(spikes, RaggedSpikes):
+        return spikes, np.array([len(spikes)]), True
+    if all(_is_trial(s) for s in spikes):
+        trials = RaggedSpikes.from_trials(spikes)
+        return trials, np.array([len(trials)]), True
+    runs = [s if isinstance(s, RaggedSpikes) else RaggedSpikes.from_trials([s] if _is_trial(s) else s)
+            for s in spikes]
+    return RaggedSpikes.concatenate(runs), np.array([len(r) for r in runs]), False
+
+
+def _run_sums(rows, ntrials):
+    # sums the rows of the trials of each run
+    sums = np.zeros((len(ntrials),) + rows.shape[1:], dtype=rows.dtype)
+    filled = ntrials > 0
+    if filled.any():
+        starts = np.concatenate(([0], np.cumsum(ntrials)[:-1]))[filled]
+        sums[filled] = np.add.reduceat(rows, starts, axis=0)
+    return sums
+
+
+def _run_means(rows, ntrials, single):
+    # averages the rows of the trials of each run, runs without trials are NaN
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = _run_sums(rows, ntrials) / ntrials.reshape((-1,) + (1,) * (rows.ndim - 1))
+    return means[0] if single else means
+
+
+def _split_runs(rows, ntrials, single):
+    return rows if single else np.split(rows, np.cumsum(ntrials)[:-1])
+
+
+def psth(spikes, bins, average=True):
+    """
+    Peri-stimulus time histogram as firing rate.
+
+    :param spikes: trials of one run or a list of runs (see module documentation)
+    :param bins: bin edges
+    :param average: if False, return the rates of each trial instead of the mean over trials
+    :returns: rate for each bin (runs x bins for a list of runs; trials x bins or a list of those if not averaged)
+    """
+    trials, ntrials, single = _as_runs(spikes)
+    bins = np.asarray(bins, dtype=np.float64)
+    rates = trials.bin(bins) / np.diff(bins)
+    return _run_means(rates, ntrials, single) if average else _split_runs(rates, ntrials, single)
+
+
+def _kernel(kernel, width, dt):
+    # kernel sampled at multiples of dt, centered on its middle sample, integrating to one
+    if kernel in ('gauss', 'gaussian'):
+        m = int(np.ceil(4.0 * width / dt))
+        t = np.arange(-m, m + 1) * dt
+        return np.exp(-0.5 * (t / width) ** 2) / (np.sqrt(2.0 * np.pi) * width)
+    elif kernel in ('exp', 'exponential'):
+        m = int(np.ceil(8.0 * width / dt))
+        t = np.arange(-m, m + 1) * dt
+        return np.where(t >= 0.0, np.exp(-np.abs(t) / width) / width, 0.0)
+    elif kernel == 'box':
+        m = int(np.ceil(0.5 * width / dt))
+        t = np.arange(-m, m + 1) * dt
+        return np.where(np.abs(t) <= 0.5 * width, 1.0 / width, 0.0)
+    raise ValueError("Unknown kernel %s" % (kernel,))
+
+
+def _convolve_rows(x, k):
+    # full convolution of every row of x with k
+    n = x.shape[1] + len(k) - 1
+    if len(k) <= DIRECT_TAPS:
+        out = np.zeros((x.shape[0], n))
+        for i, w in enumerate(k):
+            if w != 0.0:
+                out[:, i:i + x.shape[1]] += w * x
+        return out
+    size = 1 << int(np.ceil(np.log2(n)))
+    return np.fft.irfft(np.fft.rfft(x, size, axis=1) * np.fft.rfft(k, size), size, axis=1)[:, :n]
+
+
+def kernel_rate(spikes, time, kernel='gauss', width=0.002, average=True):
+    """
+    Firing rate as the sum of kernels centered on the spikes. The spikes are counted on the
+    time grid (plus a margin of the kernel size, so that spikes outside of the window
+    contribute as well) and the counts are convolved with the kernel, via FFT for long kernels.
+
+    :param spikes: trials of one run or a list of runs (see module documentation)
+    :param time: equally spaced times
+    :param kernel: 'gauss' (width is the standard deviation), 'exp' (causal exponential, width is
+                   the time constant) or 'box' (width is the full width)
+    :param width: width of the kernel
+    :param average: if False, return the rates of each trial instead of the mean over trials
+    :returns: rate at each time (runs x time for a list of runs; trials x time or a list of those if not averaged)
+    """
+    trials, ntrials, single = _as_runs(spikes)
+    time = np.asarray(time, dtype=np.float64)
+    if len(time) < 2:
+        raise ValueError("kernel_rate needs at least two times")
+    dt = time[1] - time[0]
+    k = _kernel(kernel, width, dt)
+    m = len(k) // 2
+    edges = time[0] + (np.arange(-m, len(time) + m + 1) - 0.5) * dt
+    counts = trials.bin(edges).astype(np.float64)
+    rates = _convolve_rows(counts, k)[:, 2 * m:2 * m + len(time)]
+    return _run_means(rates, ntrials, single) if average else _split_runs(rates, ntrials, single)
+
+
+def spike_counts(spikes, t0=-np.inf, t1=np.inf):
+    """
+    Number of spikes of each trial in the window from t0 (inclusive) to t1 (exclusive).
+
+    :param spikes: trials of one run or a list of runs (see module documentation)
+    :param t0: start of the window, scalar or one value per trial
+    :param t1: end of the window, scalar or one value per trial
+    :returns: array with the count of each trial (or a list of those for a list of runs)
+    """
+    trials, ntrials, single = _as_runs(spikes)
+    counts = trials.counts()
+    t0 = np.repeat(t0, counts) if np.ndim(t0) > 0 else t0
+    t1 = np.repeat(t1, counts) if np.ndim(t1) > 0 else t1
+    inside = (trials.values >= t0) & (trials.values < t1)
+    return _split_runs(np.bincount(trials.trial_index()[inside], minlength=len(trials)), ntrials, single)
+
+
+def isi_histogram(spikes, bins, density=False):
+    """
+    Histogram of the interspike intervals within the trials of each run.
+
+    :param spikes: trials of one run or a list of runs (see module documentation)
+    :param bins: bin edges
+    :param density: if True, normalize each histogram to a probability density
+    :returns: counts (or densities) of each bin (runs x bins for a list of runs)
+    """
+    trials, ntrials, single = _as_runs(spikes)
+    bins = np.asarray(bins, dtype=np.float64)
+    isis = trials.intervals()
+    counts = isis.bin(bins)
+    nisi = _run_sums(counts, ntrials)
+    if density:
+        total = nisi.sum(axis=1, keepdims=True)
+        nisi = nisi / np.where(total > 0, total, 1) / np.diff(bins)
+    return nisi[0] if single else nisi
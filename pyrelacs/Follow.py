@@ -0,0 +1,181 @@
+"""
+Loading a recording while relacs is still writing it.
+
+The functions in this module keep byte offsets into the files of a recording and poll them
+for new data. Only complete lines are parsed, so half written lines are picked up once
+relacs has finished them, and every trial is returned as soon as it is complete.
+
+>>> for info, key, time, data in follow_traces('2016-11-28-aa', repro='SAM', interval=0.5, timeout=60.0):
+...     plt.plot(time, data[0])
+"""
+import os
+import time as _time
+import warnings
+
+from numpy import arange, asarray, float32, frombuffer, isnan
+
+from .DataLoader import MetaParser, _convert_block
+from .Quantities import parse_quantity
+
+
+class FileTail(object):
+    """
+    Reads the complete lines that are appended to a growing file.
+
+    :param filename: name of the file
+    :param offset: byte offset to start reading from
+    :param chunksize: maximum number of bytes read at once
+    """
+
+    def __init__(self, filename, offset=0, chunksize=1 << 24):
+        self.filename = filename
+        self.offset = offset
+        self.chunksize = chunksize
+
+    def readlines(self):
+        """
+        Returns the complete lines written since the last call (a possibly half written last
+        line is left for the next call).
+
+        :returns: list of lines (bytes including the line break)
+        """
+        if not os.path.isfile(self.filename) or os.path.getsize(self.filename) <= self.offset:
+            return []
+        with open(self.filename, 'rb') as fid:
+            fid.seek(self.offset)
+            buffer = fid.read(self.chunksize)
+        end = buffer.rfind(b'\n') + 1
+        self.offset += end
+        return buffer[:end].splitlines(True)
+
+
+def _poll(read, interval, timeout):
+    # calls read until it returns something, or the timeout passed without new data
+    start = _time.time()
+    while True:
+        ret = read()
+        if ret:
+            return ret
+        if timeout is not None and _time.time() - start >= timeout:
+            return None
+        _time.sleep(interval)
+
+
+def follow(filename, return_array=True, interval=1.0, timeout=None):
+    """
+    Like :func:`pyrelacs.DataLoader.iload`, but follows the file while it grows. Every complete
+    data line is returned as soon as it is written; lines of a data block that arrive together
+    are returned together. Several consecutive results can therefore belong to the same block.
+
+    :param filename: Filename of the data file.
+    :param return_array: if True return the data as numpy array, otherwise as list (see iload)
+    :param interval: polling interval in seconds
+    :param timeout: stop if no new line was written for this many seconds (None: follow forever)
+    :returns: generator of metadata, key, and data
+    """
+    tail = FileTail(filename)
+    parser = MetaParser()
+    within_data = False
+    while True:
+        lines = _poll(tail.readlines, interval, timeout)
+        if lines is None:
+            return
+        rows = []
+        for raw in lines:
+            line = raw.decode(errors='replace').strip()
+            if line and not line.startswith('#'):
+                if not within_data:
+                    parser.data()
+                    within_data = True
+                rows.append(raw)
+                continue
+
+            if len(rows) > 0:
+                yield list(parser.meta_data), tuple(parser.key), _convert_block(b''.join(rows), return_array)
+                rows = []
+            within_data = False
+            if parser.line(line):
+                yield list(parser.meta_data), tuple(parser.key), _convert_block(b'', return_array)
+        if len(rows) > 0:
+            yield list(parser.meta_data), tuple(parser.key), _convert_block(b''.join(rows), return_array)
+
+
+class RawTail(object):
+    """
+    Reads windows of a growing trace-N.raw file.
+
+    :param filename: name of the raw trace file
+    :param dtype: data type of the samples
+    """
+
+    def __init__(self, filename, dtype=float32):
+        self.filename = filename
+        self.dtype = dtype
+        self.itemsize = asarray([], dtype=dtype).itemsize
+
+    def __len__(self):
+        return os.path.getsize(self.filename) // self.itemsize if os.path.isfile(self.filename) else 0
+
+    def window(self, start, stop):
+        start = max(start, 0)
+        stop = max(stop, start)
+        with open(self.filename, 'rb') as fid:
+            fid.seek(start * self.itemsize)
+            buffer = fid.read((stop - start) * self.itemsize)
+        return frombuffer(buffer[:len(buffer) - len(buffer) % self.itemsize], dtype=self.dtype)
+
+
+def follow_traces(basedir, repro='', before=0.0, after=0.0, interval=1.0, timeout=None):
+    """
+    Like :func:`pyrelacs.DataLoader.iload_traces`, but follows a recording while it is being
+    acquired. Returns every trial of stimuli.dat as soon as its row is written and all traces
+    contain the samples up to after seconds after the end of the stimulus. Trials without a
+    duration (e.g. of BaselineActivity) are skipped.
+
+    :param basedir: directory of the recording
+    :param repro: only return trials of this RePro (all if empty)
+    :param before: time before the trial start in seconds
+    :param after: time after the stimulus end in seconds
+    :param interval: polling interval in seconds
+    :param timeout: stop if no new data was written for this many seconds (None: follow forever)
+    :returns: generator of metadata, key (with the row of the trial appended), time, and data (traces x samples)
+    """
+    traces = []
+    deltat = None
+    for info, key, dat in follow('%s/stimuli.dat' % basedir, False, interval, timeout):
+        if len(traces) == 0:
+            while os.path.isfile('%s/trace-%i.raw' % (basedir, len(traces) + 1)):
+                traces.append(RawTail('%s/trace-%i.raw' % (basedir, len(traces) + 1)))
+        if len(info) == 0:
+            continue
+        if deltat is None:
+            deltat = parse_quantity(info[0]['sample interval%i' % 1])[0]
+        reproid = 'RePro' if 'RePro' in info[-1] else 'repro'
+        if len(repro) > 0 and info[-1].get(reproid) != repro:
+            continue
+        duration_indices = [i for i, x in enumerate(key[2]) if x == 'duration'] if len(key) > 2 else []
+
+        for d in dat:
+            if len(d) < len(traces) or not all(isinstance(d[k], float) and not isnan(d[k]) for k in range(len(traces))):
+                warnings.warn("follow_traces: Encountered incomplete '-0' trial.")
+                continue
+            durations = [0.001 * d[i] if key[3][i] == 'ms' else d[i] for i in duration_indices
+                         if i < len(d) and isinstance(d[i], float) and not isnan(d[i])]
+            if len(durations) == 0:
+                continue
+            duration = max(durations)
+            if duration < 0.001: # if the duration is less than 1ms
+                warnings.warn("follow_traces: Skipping one trial because its duration is <1ms and therefore it is probably rubbish")
+                continue
+            l = int(before / deltat)
+            r = int((duration + after) / deltat)
+
+            # wait for the traces to be written
+            stops = [int(d[k]) + r for k in range(len(traces))]
+            complete = lambda: all(len(trace) >= stop for trace, stop in zip(traces, stops))
+            if _poll(complete, interval, timeout) is None:
+                warnings.warn("follow_traces: Timeout while waiting for the traces of a trial.")
+                return
+            x = asarray([trace.window(int(d[k]) - l, stops[k]) for k, trace in enumerate(traces)])
+            time = arange(0.0, x.shape[1]) * deltat - before
+            yield info, key + (tuple(d),), time, x
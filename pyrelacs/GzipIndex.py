@@ -0,0 +1,127 @@
+"""
+Random access to gzip compressed relacs files.
+
+Seeking in a gzip stream normally means decompressing everything before the target
+position. With the optional `indexed_gzip <https://github.com/pauldmccarthy/indexed_gzip>`_
+package, the decompressor state is checkpointed every few MB of uncompressed data
+(seek points). The seek points are stored in a sidecar file next to the compressed file,
+so that later sessions can jump into the middle of e.g. stimuli.dat.gz right away.
+
+Without indexed_gzip, :func:`open_gzip` falls back to sequential decompression.
+"""
+import gzip
+from os import path
+import warnings
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+GZIP_SPACING = 4 * 1024 * 1024
+
+
+def gzip_index_filename(filename):
+    """
+    Returns the name of the sidecar file the seek points of filename are stored in.
+    """
+    return filename + '.gzidx'
+
+
+class GzipSeekFile(object):
+    """
+    Seekable binary file object for a gzip compressed file. Seek points are created
+    while the file is read and are imported from and exported to the sidecar file
+    (see :func:`gzip_index_filename`). A sidecar file older than the compressed file is ignored.
+
+    :param filename: name of the gzip file
+    :param spacing: number of uncompressed bytes between two seek points
+    """
+
+    def __init__(self, filename, spacing=GZIP_SPACING):
+        self.filename = filename
+        self.index_filename = gzip_index_filename(filename)
+        self.fid = indexed_gzip.IndexedGzipFile(filename, spacing=spacing)
+        self.imported_points = 0
+        if path.isfile(self.index_filename) and path.getmtime(self.index_filename) >= path.getmtime(filename):
+            try:
+                self.fid.import_index(self.index_filename)
+                self.imported_points = self.seek_points()
+            except Exception as e:
+                warnings.warn("Could not import seek points from %s: %s" % (self.index_filename, e))
+
+    def seek_points(self):
+        """
+        Returns the number of seek points currently known.
+        """
+        return len(list(self.fid.seek_points()))
+
+    def build_full_index(self):
+        """
+        Runs once through the whole file and creates all seek points.
+        """
+        self.fid.build_full_index()
+
+    def read(self, size=-1):
+        return self.fid.read(size)
+
+    def readline(self, size=-1):
+        return self.fid.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self.fid.seek(offset, whence)
+
+    def tell(self):
+        return self.fid.tell()
+
+    def __iter__(self):
+        return iter(self.fid)
+
+    def close(self):
+        """
+        Closes the file. Seek points that were created since the file was opened are
+        stored in the sidecar file.
+        """
+        if self.fid.closed:
+            return
+        if self.seek_points() > self.imported_points:
+            try:
+                self.fid.export_index(self.index_filename)
+            except Exception as e:
+                warnings.warn("Could not store seek points in %s: %s" % (self.index_filename, e))
+        self.fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_gzip(filename, mode='rb', spacing=GZIP_SPACING):
+    """
+    Opens a gzip compressed file. Files opened for reading in binary mode support fast
+    random access via seek points if indexed_gzip is installed.
+
+    :param filename: name of the gzip file
+    :param mode: mode in which the file will be opened
+    :param spacing: number of uncompressed bytes between two seek points
+    :returns: a file object
+    """
+    if indexed_gzip is not None and mode in ('r', 'rb'):
+        return GzipSeekFile(filename, spacing=spacing)
+    return gzip.open(filename, mode)
+
+
+def build_gzip_index(filename, spacing=GZIP_SPACING):
+    """
+    Creates all seek points of a gzip compressed file and stores them in the sidecar file.
+    Useful to prepare an archive once before it is accessed randomly.
+
+    :param filename: name of the gzip file
+    :param spacing: number of uncompressed bytes between two seek points
+    """
+    if indexed_gzip is None:
+        raise ImportError("Building a gzip index requires the indexed_gzip package.")
+    with GzipSeekFile(filename, spacing=spacing) as fid:
+        fid.build_full_index()
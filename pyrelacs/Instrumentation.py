@@ -0,0 +1,158 @@
+"""
+Opt-in instrumentation of the loaders.
+
+Stages of :mod:`pyrelacs.DataLoader` and :mod:`pyrelacs.DataClasses` record their wall time,
+number of calls, bytes and lines read, cache hits and misses, and the memory held in loaded
+blocks while an :func:`instrument` context is active. Outside of it, instrumented functions
+only check a module flag.
+
+>>> with instrument() as report:
+...     stimuli = load('2014-06-06-aa/stimuli.dat')
+...     stimuli.select({'RePro': 'SAM'})
+>>> print(report)
+>>> report.dump('profile.json')
+
+Times of nested stages are inclusive, e.g. the time of RelacsFile.__init__ contains the time
+of parse_structure and parse_meta.
+"""
+from __future__ import print_function
+from contextlib import contextmanager
+import functools
+import inspect
+import json
+import time
+
+enabled = False
+_report = None
+
+
+class Report(object):
+    """
+    Timers and counters collected by :func:`instrument`.
+
+    **timers:** dictionary mapping stage names to [number of calls, seconds]
+
+    **counters:** dictionary mapping counter names (e.g. 'DataLoader.bytes read') to their value
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+
+    def as_dict(self):
+        return {'timers': dict((k, {'calls': v[0], 'seconds': v[1]}) for k, v in self.timers.items()),
+                'counters': dict(self.counters)}
+
+    def dump(self, fid):
+        """
+        Writes the report as JSON.
+
+        :param fid: filename or file object
+        """
+        if hasattr(fid, 'write'):
+            json.dump(self.as_dict(), fid, indent=2, sort_keys=True)
+        else:
+            with open(fid, 'w') as f:
+                json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def __str__(self):
+        lines = ['%-40s %8s %12s' % ('stage', 'calls', 'seconds')]
+        for name, (calls, seconds) in sorted(self.timers.items(), key=lambda e: -e[1][1]):
+            lines.append('%-40s %8i %12.4f' % (name, calls, seconds))
+        lines.append('')
+        lines.append('%-40s %21s' % ('counter', 'value'))
+        for name, value in sorted(self.counters.items()):
+            lines.append('%-40s %21s' % (name, value))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+@contextmanager
+def instrument():
+    """
+    Context manager that enables the instrumentation and yields the :class:`Report` the
+    timers and counters are collected in.
+    """
+    global enabled, _report
+    previous = enabled, _report
+    enabled, _report = True, Report()
+    try:
+        yield _report
+    finally:
+        enabled, _report = previous
+
+
+def add_time(stage, seconds, calls=1):
+    timer = _report.timers.setdefault(stage, [0, 0.0])
+    timer[0] += calls
+    timer[1] += seconds
+
+
+def count(name, n=1):
+    """
+    Adds n to a counter. Callers check :data:`enabled` first.
+    """
+    _report.counters[name] = _report.counters.get(name, 0) + n
+
+
+def _timed_generator(stage, gen):
+    # only the time spent inside the generator is counted, not the one of the consumer
+    seconds = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(gen)
+            except StopIteration:
+                seconds += time.time() - start
+                return
+            seconds += time.time() - start
+            yield item
+    finally:
+        gen.close()
+        if enabled:
+            add_time(stage, seconds)
+
+
+def timed(stage):
+    """
+    Decorator that records the wall time and number of calls of a function (or generator function)
+    under the name stage while the instrumentation is enabled.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return func(*args, **kwargs)
+                return _timed_generator(stage, func(*args, **kwargs))
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return func(*args, **kwargs)
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    if enabled:
+                        add_time(stage, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def nbytes(data):
+    """
+    Estimates the memory held by loaded data (arrays, nested lists of numbers and strings).
+    """
+    if hasattr(data, 'nbytes'):
+        return data.nbytes
+    if isinstance(data, (list, tuple)):
+        return sum(nbytes(d) for d in data)
+    if hasattr(data, 'values') and hasattr(data, 'offsets'):
+        return data.values.nbytes + data.offsets.nbytes
+    if isinstance(data, str):
+        return len(data)
+    return 8
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of values with units as they appear in relacs metadata (e.g. 'duration: 100ms',
+'sample interval1: 0.05ms', 'contrast: 20%').
+
+:func:`parse_quantity` knows the units relacs writes and converts them to SI. Other units are
+handed to `pint <https://pint.readthedocs.io>`_ if it is installed. Results are cached, since
+the same strings appear over and over again in a recording.
+
+>>> parse_quantity('100ms')
+(0.1, 's')
+>>> parse_quantity('20%')
+(20.0, '%')
+"""
+import re
+
+try:
+    from functools import lru_cache
+except ImportError:  # python 2
+    def lru_cache(maxsize=None):
+        def decorator(func):
+            cache = {}
+
+            def wrapper(arg):
+                if arg not in cache:
+                    if maxsize is not None and len(cache) >= maxsize:
+                        cache.clear()
+                    cache[arg] = func(arg)
+                return cache[arg]
+            return wrapper
+        return decorator
+
+# units start with a letter, '%' or a degree sign, like 'ms', 'mV/cm', 'degC', or '%'
+_quantity = re.compile(u'^\\s*([-+]?(?:\\d+\\.?\\d*|\\.\\d+)(?:[eE][-+]?\\d+)?)\\s*'
+                       u'((?:[^\\W\\d_]|[%\u00b0])(?:[^\\W_]|[%\u00b0/^*.\\-])*)?\\s*$', re.UNICODE)
+
+PREFIXES = {'p': 1e-12, 'n': 1e-9, 'u': 1e-6, u'µ': 1e-6, 'm': 1e-3, 'c': 1e-2, 'k': 1e3, 'M': 1e6, 'G': 1e9}
+SI_UNITS = {'s': 's', 'Hz': 'Hz', 'V': 'V', 'A': 'A', 'Ohm': 'Ohm', 'ohm': 'Ohm', u'Ω': 'Ohm', 'S': 'S',
+            'F': 'F', 'm': 'm'}
+# units that are not prefixed: name -> (factor, SI unit)
+UNITS = {'min': (60.0, 's'), 'h': (3600.0, 's'), 'sec': (1.0, 's'), 'g': (1e-3, 'kg'), 'kg': (1.0, 'kg'),
+         'dB': (1.0, 'dB'), '%': (1.0, '%'), 'deg': (1.0, 'deg'), 'degC': (1.0, 'degC'), u'°C': (1.0, 'degC'), 'C': (1.0, 'degC'),
+         'rad': (1.0, 'rad'), 'cyc': (1.0, 'cyc')}
+
+_ureg = None
+
+
+def unit_factor(unit):
+    """
+    Returns the factor that converts a value in unit into SI and the SI unit, or None if the unit is not known.
+
+    >>> unit_factor('kHz')
+    (1000.0, 'Hz')
+    """
+    if unit in UNITS:
+        return UNITS[unit]
+    if unit in SI_UNITS:
+        return 1.0, SI_UNITS[unit]
+    if len(unit) > 1 and unit[0] in PREFIXES and unit[1:] in SI_UNITS:
+        return PREFIXES[unit[0]], SI_UNITS[unit[1:]]
+    return None
+
+
+def _pint_quantity(value_string):
+    global _ureg
+    try:
+        from pint import UnitRegistry
+    except ImportError:
+        return None
+    if _ureg is None:
+        _ureg = UnitRegistry()
+    try:
+        q = _ureg.parse_expression(value_string).to_base_units()
+    except Exception:
+        return None
+    if not hasattr(q, 'magnitude'):
+        return None
+    return q.magnitude, "{:~}".format(q.units).replace(" ", "")
+
+
+@lru_cache(maxsize=4096)
+def parse_quantity(value_string):
+    """
+    Splits a string like '0.05ms' into its value and unit and converts it to SI.
+
+    :param value_string: number with an optional unit
+    :returns: value and SI unit. The unit is None for plain numbers. Strings that are not
+              a number with a known unit (e.g. dates, times, or text) are returned unchanged
+              with unit None.
+
+    >>> parse_quantity('2014-06-06')
+    ('2014-06-06', None)
+    >>> parse_quantity('10:31:23')
+    ('10:31:23', None)
+    >>> parse_quantity('2nd trial')
+    ('2nd trial', None)
+    >>> parse_quantity('2nd')
+    ('2nd', None)
+    """
+    m = _quantity.match(value_string)
+    if m is None:
+        return value_string, None
+    value, unit = m.groups()
+    value = float(value)
+    if not unit:
+        return value, None
+    known = unit_factor(unit)
+    if known is not None:
+        return value * known[0], known[1]
+    q = _pint_quantity(value_string)
+    if q is not None:
+        return q
+    return value_string, None
+
+
+def parse_seconds(value_string):
+    """
+    Returns a time like '100ms' or '1.5s' in seconds.
+    """
+    value, unit = parse_quantity(value_string)
+    if unit not in ('s', None):
+        raise ValueError("%s is not a time" % (value_string,))
+    return value
@@ -0,0 +1,72 @@
+"""
+Memory mapped access to the raw traces (trace-N.raw) of a relacs recording.
+
+The raw trace files contain the continuously recorded float32 samples of one analog
+input trace each and can be several GB large. Instead of reading them into memory,
+they are memory mapped once and trial windows are handed out as views into the map.
+"""
+from os import path
+from numpy import memmap, float32, empty, asarray, array, dtype as npdtype
+
+
+class RawTrace(object):
+    """
+    A memory mapped trace-N.raw file.
+
+    :param filename: name of the raw trace file
+    :param dtype: data type of the samples
+    """
+
+    def __init__(self, filename, dtype=float32):
+        self.filename = filename
+        self.dtype = npdtype(dtype)
+        if path.getsize(filename) >= self.dtype.itemsize:
+            self.data = memmap(filename, dtype=self.dtype, mode='r')
+        else:
+            # empty files cannot be mapped
+            self.data = empty(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    def window(self, start, stop, copy=False):
+        """
+        Returns the samples from index start up to (but not including) stop. The window is
+        clipped to the recorded samples, so it is shorter if it reaches beyond the file.
+
+        :param start: index of the first sample
+        :param stop: index after the last sample
+        :param copy: if True, return a copy in memory instead of a view into the file
+        :returns: float32 array
+        """
+        x = asarray(self.data[max(start, 0):max(stop, 0)])
+        return array(x) if copy else x
+
+    def close(self):
+        """
+        Releases the memory map. Views handed out by :meth:`window` keep the map alive.
+        """
+        self.data = empty(0, dtype=self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def raw_trace_filename(basedir, trace_no):
+    return '%s/trace-%i.raw' % (basedir, trace_no)
+
+
+def load_raw_traces(basedir):
+    """
+    Memory maps all consecutively numbered raw trace files trace-1.raw, trace-2.raw, ... of a recording.
+
+    :param basedir: directory of the recording
+    :returns: list of RawTrace objects, the first one belongs to trace-1.raw
+    """
+    traces = []
+    while path.isfile(raw_trace_filename(basedir, len(traces) + 1)):
+        traces.append(RawTrace(raw_trace_filename(basedir, len(traces) + 1)))
+    return traces
@@ -0,0 +1,144 @@
+"""
+Compact container for the spike trains of many trials.
+
+Merged spike trials (see :func:`pyrelacs.DataLoader.iload_spike_blocks` and
+:class:`pyrelacs.DataClasses.RelacsFile.SpikeFile`) are usually handled as lists of small
+arrays. RaggedSpikes stores all spike times in one flat array together with the offsets
+of the trials, so that operations on all trials can be done without a loop in Python.
+
+>>> spikes = RaggedSpikes.from_trials([np.array([0.1, 0.2]), np.array([]), np.array([0.05])])
+>>> spikes.counts()
+array([2, 0, 1])
+>>> spikes[0]
+array([0.1, 0.2])
+"""
+import numpy as np
+
+
+class RaggedSpikes(object):
+    """
+    Spike times of several trials in a flat array. The spike times of trial i are
+    values[offsets[i]:offsets[i+1]].
+
+    :param values: flat float64 array of the spike times of all trials
+    :param offsets: int array with len(trials) + 1 entries, starting with 0
+    """
+
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or self.offsets[-1] != len(self.values):
+            raise ValueError("offsets must start with 0 and end with the number of spike times")
+
+    @classmethod
+    def from_trials(cls, trials):
+        """
+        Creates a RaggedSpikes object from a list of arrays with the spike times of each trial.
+
+        :param trials: list of arrays (or scalars for trials with a single spike)
+        :returns: RaggedSpikes object
+        """
+        trials = [np.ravel(t) for t in trials]
+        offsets = np.zeros(len(trials) + 1, dtype=np.intp)
+        np.cumsum([len(t) for t in trials], out=offsets[1:])
+        values = np.concatenate(trials) if len(trials) > 0 else np.zeros(0)
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return RaggedSpikes.from_trials([self[i] for i in range(start, stop, step)])
+            stop = max(start, stop)
+            return RaggedSpikes(self.values[self.offsets[start]:self.offsets[stop]],
+                                self.offsets[start:stop + 1] - self.offsets[start])
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError("trial index out of range")
+        return self.values[self.offsets[item]:self.offsets[item + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __repr__(self):
+        return "RaggedSpikes with %i trials and %i spikes" % (len(self), len(self.values))
+
+    def counts(self):
+        """
+        Returns the number of spikes in each trial.
+        """
+        return np.diff(self.offsets)
+
+    def trial_index(self):
+        """
+        Returns the trial number of each spike time in values.
+        """
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    def to_list(self):
+        """
+        Returns the spike times as a list of arrays, one per trial.
+        """
+        return [np.array(t) for t in self]
+
+    def shift(self, delta):
+        """
+        Returns a new RaggedSpikes object with all spike times shifted by delta.
+
+        :param delta: scalar or array with one shift per trial
+        :returns: RaggedSpikes object
+        """
+        delta = np.asarray(delta, dtype=np.float64)
+        if delta.ndim > 0:
+            if len(delta) != len(self):
+                raise ValueError("Need one shift per trial")
+            delta = np.repeat(delta, self.counts())
+        return RaggedSpikes(self.values + delta, self.offsets.copy())
+
+    def bin(self, bins):
+        """
+        Counts the spikes of every trial in the given bins. Like numpy.histogram, the bins are
+        half open except for the last one, which includes its right edge.
+
+        :param bins: monotonically increasing array of bin edges
+        :returns: array with one row of spike counts per trial
+        """
+        bins = np.asarray(bins, dtype=np.float64)
+        nbins = len(bins) - 1
+        idx = np.searchsorted(bins, self.values, side='right') - 1
+        idx[self.values == bins[-1]] = nbins - 1
+        valid = (idx >= 0) & (idx < nbins)
+        flat = self.trial_index()[valid] * nbins + idx[valid]
+        return np.bincount(flat, minlength=len(self) * nbins).reshape(len(self), nbins)
+
+    def intervals(self):
+        """
+        Returns the interspike intervals within each trial (none across trials).
+
+        :returns: RaggedSpikes object with len(counts) - 1 intervals per non-empty trial
+        """
+        inside = np.ones(max(len(self.values) - 1, 0), dtype=bool)
+        boundaries = self.offsets[1:-1] - 1
+        inside[boundaries[(boundaries >= 0) & (boundaries < len(inside))]] = False
+        offsets = np.zeros(len(self) + 1, dtype=np.intp)
+        np.cumsum(np.clip(self.counts() - 1, 0, None), out=offsets[1:])
+        return RaggedSpikes(np.diff(self.values)[inside], offsets)
+
+    @classmethod
+    def concatenate(cls, spikes):
+        """
+        Joins the trials of several RaggedSpikes objects (e.g. of several runs of a RePro).
+
+        :param spikes: list of RaggedSpikes objects
+        :returns: RaggedSpikes object with the trials of all objects in order
+        """
+        if len(spikes) == 0:
+            return cls(np.zeros(0), np.zeros(1, dtype=np.intp))
+        ends = np.cumsum([len(s.values) for s in spikes])
+        offsets = [spikes[0].offsets] + [s.offsets[1:] + e for s, e in zip(spikes[1:], ends[:-1])]
+        return cls(np.concatenate([s.values for s in spikes]), np.concatenate(offsets))
@@ -0,0 +1,194 @@
+"""
+Multi-resolution min/max/mean summaries of raw traces for plotting.
+
+For every trace-N.raw a pyramid of levels is stored next to it (trace-N.raw.pyramid.npy).
+Level k summarizes bins of FIRST_FACTOR * BASE**k samples by their minimum, maximum and mean.
+The pyramid is built in a single streaming pass over the raw trace and rebuilt when the
+raw trace is newer or changed its size.
+
+>>> time, lo, hi, mean = trace_overview('2016-11-28-aa', 1, 0.0, 3600.0, width=1600)
+>>> plt.fill_between(time, lo, hi)
+"""
+import os
+from os import path
+import warnings
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .RawTraces import RawTrace, raw_trace_filename
+from .Quantities import parse_quantity
+
+FIRST_FACTOR = 64
+BASE = 8
+CHUNKSIZE = 1 << 22  # samples read at once, a multiple of all factors below it
+
+
+def pyramid_filename(filename):
+    """
+    Returns the name of the file the pyramid of the raw trace filename is stored in.
+    """
+    return filename + '.pyramid.npy'
+
+
+def pyramid_factors(n):
+    """
+    Returns the number of samples per bin of each level of the pyramid of a trace with n samples.
+    """
+    factors = [FIRST_FACTOR]
+    while factors[-1] < n:
+        factors.append(factors[-1] * BASE)
+    return factors
+
+
+def _level_sizes(n, factors):
+    return [(n + f - 1) // f for f in factors]
+
+
+def _reduce(lo, hi, mean, counts, step):
+    # combines groups of step consecutive bins (the last group may be shorter),
+    # counts are the number of samples in each bin (None for single samples)
+    idx = np.arange(0, len(lo), step)
+    out = np.empty((len(idx), 3), dtype=np.float32)
+    out[:, 0] = np.minimum.reduceat(lo, idx)
+    out[:, 1] = np.maximum.reduceat(hi, idx)
+    if counts is None:
+        out[:, 2] = np.add.reduceat(mean, idx) / np.diff(np.append(idx, len(lo)))
+    else:
+        out[:, 2] = np.add.reduceat(mean * counts, idx) / np.add.reduceat(counts, idx)
+    return out
+
+
+def build_pyramid(filename):
+    """
+    Builds the pyramid of a raw trace file in a single pass and stores it next to it.
+    Memory usage is bounded by the chunk size.
+
+    :param filename: name of the raw trace file
+    """
+    x = RawTrace(filename).data
+    n = len(x)
+    if n == 0:
+        raise ValueError("Cannot build a pyramid of the empty raw trace %s" % filename)
+    factors = pyramid_factors(n)
+    sizes = _level_sizes(n, factors)
+    tmpname = pyramid_filename(filename) + '.tmp.npy'
+    out = open_memmap(tmpname, mode='w+', dtype=np.float32, shape=(sum(sizes), 3))
+
+    # first level from the raw samples
+    f = factors[0]
+    for start in range(0, n, CHUNKSIZE):
+        chunk = np.asarray(x[start:start + CHUNKSIZE], dtype=np.float64)
+        out[start // f:start // f + (len(chunk) + f - 1) // f] = _reduce(chunk, chunk, chunk, None, f)
+
+    # higher levels from the level below
+    offset = 0
+    for k in range(1, len(factors)):
+        below = out[offset:offset + sizes[k - 1]]
+        offset += sizes[k - 1]
+        step = CHUNKSIZE // factors[0]
+        for start in range(0, sizes[k - 1], step):
+            d = np.asarray(below[start:start + step], dtype=np.float64)
+            # all bins below hold factors[k - 1] samples, except for the last one of the level
+            counts = np.full(len(d), float(factors[k - 1]))
+            if start + len(d) == sizes[k - 1]:
+                counts[-1] = n - factors[k - 1] * (sizes[k - 1] - 1)
+            level = _reduce(d[:, 0], d[:, 1], d[:, 2], counts, BASE)
+            out[offset + start // BASE:offset + start // BASE + len(level)] = level
+    out.flush()
+    del out
+    os.replace(tmpname, pyramid_filename(filename))
+
+
+class TracePyramid(object):
+    """
+    Pyramid of a raw trace file. It is loaded from the file next to the raw trace and
+    (re)built if necessary.
+
+    :param filename: name of the raw trace file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.raw = RawTrace(filename)
+        self.n = len(self.raw)
+        self.factors = pyramid_factors(self.n)
+        sizes = _level_sizes(self.n, self.factors)
+        self.offsets = np.cumsum([0] + sizes)
+
+        pname = pyramid_filename(filename)
+        self.data = None
+        if self.n == 0:
+            # nothing to summarize, select returns the (empty) raw samples
+            self.data = np.zeros((0, 3), dtype=np.float32)
+            self.factors = []
+        elif path.isfile(pname) and path.getmtime(pname) >= path.getmtime(filename):
+            data = np.load(pname, mmap_mode='r')
+            if data.shape == (self.offsets[-1], 3):
+                self.data = data
+        if self.data is None:
+            try:
+                build_pyramid(filename)
+                self.data = np.load(pname, mmap_mode='r')
+            except (IOError, OSError) as e:
+                warnings.warn("Could not store pyramid for %s: %s" % (filename, e))
+                self.data = np.zeros((0, 3), dtype=np.float32)
+                self.factors = []
+
+    def level(self, k):
+        """
+        Returns level k as array with columns minimum, maximum, and mean.
+        """
+        return self.data[self.offsets[k]:self.offsets[k + 1]]
+
+    def select(self, start, stop, width):
+        """
+        Returns the summary of the samples from start to stop with at least width bins
+        (e.g. pixels), using the coarsest level that still has that resolution. If no level
+        is fine enough, the raw samples are returned.
+
+        :param start: index of the first sample
+        :param stop: index after the last sample
+        :param width: minimum number of bins
+        :returns: number of samples per bin, sample index of each bin, minimum, maximum, and mean
+        """
+        start = max(start, 0)
+        stop = min(stop, self.n)
+        per_bin = (stop - start) // max(width, 1)
+        levels = [k for k, f in enumerate(self.factors) if f <= per_bin]
+        if len(levels) == 0:
+            x = self.raw.window(start, stop)
+            return 1, np.arange(start, start + len(x)), x, x, x
+        k = levels[-1]
+        f = self.factors[k]
+        b0, b1 = start // f, (stop + f - 1) // f
+        d = self.level(k)[b0:b1]
+        return f, np.arange(b0, b1) * f, d[:, 0], d[:, 1], d[:, 2]
+
+
+def trace_overview(basedir, trace_no, t0, t1, width):
+    """
+    Returns the summary of trace trace_no of a recording between times t0 and t1 for plotting
+    it with width pixels. The sample interval is taken from stimuli.dat.
+
+    :param basedir: directory of the recording
+    :param trace_no: number of the trace (1 for trace-1.raw)
+    :param t0: start time in seconds
+    :param t1: end time in seconds
+    :param width: number of pixels
+    :returns: time, minimum, maximum, and mean of each bin
+    """
+    deltat = None
+    with open('%s/stimuli.dat' % basedir, 'r') as fid:
+        for line in fid:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                break
+            if line.lstrip('# ').startswith('sample interval%i:' % trace_no):
+                deltat = parse_quantity(line.split(':', 1)[1].strip())[0]
+                break
+    if deltat is None:
+        raise ValueError("No sample interval for trace %i in %s/stimuli.dat" % (trace_no, basedir))
+    pyramid = TracePyramid(raw_trace_filename(basedir, trace_no))
+    f, index, lo, hi, mean = pyramid.select(int(t0 / deltat), int(np.ceil(t1 / deltat)), width)
+    return index * deltat, lo, hi, mean
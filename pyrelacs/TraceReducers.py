@@ -0,0 +1,269 @@
+"""
+Streaming statistics of the raw traces of a recording.
+
+The raw traces (trace-N.raw) are often too large to be read into memory at once. The
+reducers in this module are fed with chunks of all traces (traces x samples) and their
+partial results can be merged, so a whole session is summarized with bounded memory and
+the chunks can be distributed over several processes:
+
+* :class:`Moments`: number of samples, mean, and variance of each trace (Welford/Chan)
+* :class:`Histogram`: amplitude histogram of each trace with fixed bin edges
+* :class:`Welch`: power spectral densities and cross-spectral densities between the traces
+
+>>> moments, hist, psd = reduce_traces('2016-11-28-aa', [Moments(), Histogram(100, (-5.0, 5.0)), Welch(4096, fs=20000.0)])
+>>> freqs, pxx = psd.result()
+
+Restricted to the trials of a RePro in stimuli.dat:
+
+>>> windows = trial_windows('2016-11-28-aa', repro='SAM', after=0.1)
+>>> moments, = reduce_traces('2016-11-28-aa', [Moments()], windows=windows)
+"""
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import os
+
+import numpy as np
+
+from .DataLoader import _select_trials
+from .RawTraces import RawTrace, load_raw_traces
+
+CHUNKSIZE = 1 << 20  # samples per trace read at once
+
+
+class Moments(object):
+    """
+    Number of samples, mean, and sum of squared deviations of each trace. Chunks are
+    combined with the pairwise update of Chan et al., which is numerically stable.
+    """
+    overlap = 0
+    step = 1
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x, core):
+        x = np.asarray(x[:, :core], dtype=np.float64)
+        if x.shape[1] == 0:
+            return
+        other = Moments()
+        other.n = x.shape[1]
+        other.mean = x.mean(axis=1)
+        other.m2 = ((x - other.mean[:, None]) ** 2).sum(axis=1)
+        self.merge(other)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.n / n
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+
+    def variance(self, ddof=0):
+        return self.m2 / (self.n - ddof)
+
+    def result(self):
+        """
+        :returns: number of samples, mean and variance of each trace
+        """
+        return self.n, self.mean, self.variance()
+
+
+class Histogram(object):
+    """
+    Amplitude histogram of each trace. Samples outside of the bin edges are not counted
+    (like numpy.histogram).
+
+    :param bins: number of bins or bin edges
+    :param range: lower and upper edge if bins is a number
+    """
+    overlap = 0
+    step = 1
+
+    def __init__(self, bins, range=None):
+        if np.ndim(bins) == 0:
+            if range is None:
+                raise ValueError("Histogram: the range is needed to merge histograms with %i bins" % bins)
+            bins = np.linspace(range[0], range[1], bins + 1)
+        self.edges = np.asarray(bins, dtype=np.float64)
+        self.counts = None
+
+    def update(self, x, core):
+        counts = np.array([np.histogram(trace[:core], self.edges)[0] for trace in x])
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def merge(self, other):
+        if other.counts is not None:
+            self.counts = other.counts.copy() if self.counts is None else self.counts + other.counts
+
+    def result(self):
+        """
+        :returns: bin edges and counts (traces x bins)
+        """
+        return self.edges, self.counts
+
+
+class Welch(object):
+    """
+    Power and cross-spectral densities of the traces by Welch's method: the mean of the
+    squared Fourier transforms of overlapping, Hann windowed segments with their mean removed.
+    The results agree with scipy.signal.welch and scipy.signal.csd with the default arguments.
+
+    :param nperseg: number of samples per segment
+    :param fs: sampling rate in Hertz
+    :param noverlap: number of samples two consecutive segments overlap (default: nperseg/2)
+    :param cross: if True, also compute the cross-spectral densities between all traces
+    """
+
+    def __init__(self, nperseg=4096, fs=1.0, noverlap=None, cross=False):
+        self.nperseg = nperseg
+        self.fs = fs
+        self.step = nperseg - (nperseg // 2 if noverlap is None else noverlap)
+        self.overlap = nperseg - self.step
+        self.cross = cross
+        # periodic Hann window like scipy.signal.get_window('hann', nperseg)
+        self.window = 0.5 - 0.5 * np.cos(2.0 * np.pi * np.arange(nperseg) / nperseg)
+        self.segments = 0
+        self.sums = None
+
+    def update(self, x, core):
+        # segments starting within the first core samples, the overlap belongs to the next chunk
+        starts = np.arange(0, core, self.step)
+        starts = starts[starts + self.nperseg <= x.shape[1]]
+        if len(starts) == 0:
+            return
+        segments = np.asarray(x, dtype=np.float64)[:, starts[:, None] + np.arange(self.nperseg)]
+        segments -= segments.mean(axis=-1, keepdims=True)
+        spectra = np.fft.rfft(segments * self.window, axis=-1)
+        if self.cross:
+            sums = np.einsum('isf,jsf->ijf', spectra.conj(), spectra)
+        else:
+            sums = (spectra.real ** 2 + spectra.imag ** 2).sum(axis=1)
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.segments += len(starts)
+
+    def merge(self, other):
+        if other.sums is not None:
+            self.sums = other.sums.copy() if self.sums is None else self.sums + other.sums
+            self.segments += other.segments
+
+    def result(self):
+        """
+        :returns: frequencies and one-sided spectral densities, either traces x frequencies or,
+                  with cross=True, traces x traces x frequencies with the power spectral
+                  densities on the diagonal
+        """
+        freqs = np.fft.rfftfreq(self.nperseg, 1.0 / self.fs)
+        if self.sums is None:
+            return freqs, None
+        p = self.sums / (self.segments * self.fs * (self.window ** 2).sum())
+        if self.nperseg % 2:
+            p[..., 1:] *= 2.0
+        else:
+            p[..., 1:-1] *= 2.0
+        return freqs, p
+
+
+def trial_windows(basedir, repro=None, filterfunc=None, before=0.0, after=0.0, duration=None):
+    """
+    Returns the sample ranges of the trials of stimuli.dat, selected as in
+    :func:`pyrelacs.DataLoader.load_trace_epochs`, to restrict :func:`reduce_traces` to them.
+    The start indices of the first trace are used for all traces.
+
+    :returns: array of start and stop indices (trials x 2)
+    """
+    ntraces = len(load_raw_traces(basedir))
+    deltat, starts, durations, infos = _select_trials('%s/stimuli.dat' % basedir, ntraces, repro, filterfunc, duration)
+    if len(starts) == 0:
+        return np.empty((0, 2), dtype=int)
+    l = int(before / deltat)
+    lengths = (l + (durations + after) / deltat).astype(int)
+    start = starts[:, 0] - l
+    return np.column_stack((start, start + lengths)).clip(0, None)
+
+
+def _reduce_ranges(filenames, reducers, ranges, chunksize, overlap):
+    # runs the reducers over the ranges (start, stop, limit): chunks start within start and
+    # stop and may read overlap samples beyond the chunk but not beyond limit
+    traces = [RawTrace(f) for f in filenames]
+    n = min(len(t) for t in traces)
+    for start, stop, limit in ranges:
+        limit = min(limit, n)
+        for s in range(start, min(stop, limit), chunksize):
+            core = min(chunksize, stop - s, limit - s)
+            x = np.asarray([t.window(s, min(s + core + overlap, limit)) for t in traces])
+            for r in reducers:
+                r.update(x, core)
+    for t in traces:
+        t.close()
+    return reducers
+
+
+def reduce_traces(basedir, reducers, traces=None, windows=None, chunksize=CHUNKSIZE, workers=None):
+    """
+    Runs reducers like :class:`Moments`, :class:`Histogram`, and :class:`Welch` over the raw
+    traces of a recording. The traces are read in chunks of chunksize samples (plus the overlap
+    the reducers need), which are distributed over worker processes. Each process holds a few
+    chunks at a time, so memory does not grow with the length of the recording.
+
+    :param basedir: directory of the recording
+    :param reducers: list of reducers, they are not modified
+    :param traces: numbers of the traces to reduce (default: all, 1 for trace-1.raw)
+    :param windows: sample ranges (start, stop) to restrict the reduction to, e.g. from :func:`trial_windows`.
+                    Welch segments do not cross window boundaries.
+    :param chunksize: number of samples per trace read at once
+    :param workers: number of worker processes (default: number of CPUs). With workers=1 the chunks are reduced serially.
+    :returns: list of the merged reducers in the order of reducers
+    """
+    raw = load_raw_traces(basedir)
+    if traces is not None:
+        raw = [raw[i - 1] for i in traces]
+    if len(raw) == 0:
+        raise ValueError("reduce_traces: no raw traces in %s" % basedir)
+    filenames = [t.filename for t in raw]
+    n = min(len(t) for t in raw)
+    for t in raw:
+        t.close()
+
+    # chunks start at multiples of the segment steps, so that every segment is computed exactly once
+    align = 1
+    for r in reducers:
+        align = align * r.step // _gcd(align, r.step)
+    chunksize = max(chunksize // align, 1) * align
+    overlap = int(np.max([r.overlap for r in reducers])) if len(reducers) > 0 else 0
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if windows is None:
+        # a few tasks per worker to balance the load
+        per_task = max((n // (4 * workers)) // chunksize, 1) * chunksize
+        tasks = [[(s, min(s + per_task, n), n)] for s in range(0, n, per_task)]
+    else:
+        ranges = [(int(a), int(b), int(b)) for a, b in windows if b > a]
+        ntasks = min(4 * workers, len(ranges))
+        tasks = [ranges[i::ntasks] for i in range(ntasks)]
+
+    merged = copy.deepcopy(reducers)
+    if workers == 1 or len(tasks) <= 1:
+        results = [_reduce_ranges(filenames, copy.deepcopy(reducers), task, chunksize, overlap) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_reduce_ranges, filenames, copy.deepcopy(reducers), task, chunksize, overlap)
+                       for task in tasks]
+            results = (f.result() for f in futures)
+    for partial in results:
+        for r, p in zip(merged, partial):
+            r.merge(p)
+    return merged
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
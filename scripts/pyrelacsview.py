@@ -25,3 +25,9 @@ for info, key, time, data in dl.iload_traces(datapath, repro='SingleStimulus', b
     plt.plot(time, data[0])  # V(t)
     plt.show()
 
+
+# overview of a whole raw trace, minimum and maximum per pixel from the precomputed pyramid:
+from pyrelacs.TracePyramid import trace_overview
+time, lo, hi, mean = trace_overview(datapath, 1, 0.0, 3600.0, width=1600)
+plt.fill_between(time, lo, hi)
+plt.show()
@@ -1,45 +1,28 @@
+from __future__ import print_function
 import getopt
 import glob
 from pprint import pprint
 import re
 import sys
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
 import yaml
 import numpy as np
 from IPython import embed
 
-from pint import UnitRegistry
 import nixio as nix
 
 
 from pyrelacs.DataClasses import load
 from pyrelacs.DataClasses.RelacsFile import RelacsFile
+from pyrelacs.Quantities import parse_quantity, unit_factor
 
-ureg = UnitRegistry()
 
 def get_number_and_unit(value_string):
-    if value_string.endswith('%'):
-        return (float(value_string.strip()[:-1]), '%')
-    try:
-        a = ureg.parse_expression(value_string)
-    except:
-        return (value_string, None)
-
-
-    if type(a) == list:
-        return (value_string, None)
-
-    if isinstance( a, ( int, long , float) ):
-        return (a, None)
-    else:
-        # a.ito_base_units()
-        value = a.magnitude
-        unit = "{:~}".format(a)
-        unit = unit[unit.index(" "):].replace(" ","")
-
-        if unit == 'min':
-            unit = 's'
-            value *= 60
-        return (value, unit)
+    # values are converted to SI units
+    return parse_quantity(value_string.strip())
 
 
 
@@ -52,8 +35,8 @@ data_type_converter = {
 
 
 def insert_metadata(root, d):
-    for k,v in d.iteritems():
-        if isinstance(v, dict):
+    for k,v in d.items():
+        if isinstance(v, Mapping):
             sec = root.create_section(k, 'relacs.{0:s}'.format(k))
             insert_metadata(sec, v)
         else:
@@ -91,7 +74,7 @@ def add_info(nix_file, relacsdir, block):
     try:
         info = open(relacsdir + '/info.dat').readlines()
         info = [re.sub(r'[^\x00-\x7F]+',' ', e[1:]) for e in info]
-        meta = yaml.load(''.join(info))
+        meta = yaml.safe_load(''.join(info))
     except IOError:
         meta = {}
     sec = nix_file.create_section('info', "nix.metadata")
@@ -105,10 +88,10 @@ def add_stimulus_meta(meta):
         #meta['filemeta']
         me, _, _ = mf.selectall()
         me = me[0]
-        meta['filemeta'] = me
+        meta['filemeta'] = me.flatten()
 
-    for k,v in meta.iteritems():
-        if isinstance(v,dict):
+    for k,v in list(meta.items()):
+        if isinstance(v, Mapping):
             meta[k] = add_stimulus_meta(v)
 
     return meta
@@ -122,20 +105,18 @@ def add_spikes(stimuli, spikefile, spike_times, nix_file, nix_spiketimes):
     else:
         raise Exception('Cannot determine repro')
 
-    print "Assuming RePro=%s" % (repro, )
+    print("Assuming RePro=%s" % (repro, ))
 
 
-    ureg = UnitRegistry()
-
     spikes = load(spikefile)
     spi_meta, spi_key, spi_data = spikes.selectall()
 
 
-    for run_idx, (spi_d, spi_m) in enumerate(zip(spi_data, spi_meta)):
-        print "\t%s run %i" % (repro, run_idx)
+    for run_idx, (spi_d, spi_m, spi_k) in enumerate(zip(spi_data, spi_meta, spi_key)):
+        print("\t%s run %i" % (repro, run_idx))
 
         if repro == 'FileStimulus':
-            spi_m = add_stimulus_meta(spi_m)
+            spi_m = add_stimulus_meta(spi_m.flatten())
         # match index from stimspikes with run from stimuli.dat
         stim_m, stim_k, stim_d = stimuli.subkey_select(RePro=repro, Run=spi_m['index'])
 
@@ -170,17 +151,22 @@ def add_spikes(stimuli, spikefile, spike_times, nix_file, nix_spiketimes):
         sample_interval, time_unit = get_number_and_unit(stim_m['analog input traces']['sample interval%i' % (index,)])
 
         if repro == 'FileStimulus':
-            duration = ureg.parse_expression(spi_m['duration']).to(time_unit).magnitude
+            duration = parse_quantity(spi_m['duration'])[0]
         elif repro == 'SAM':
-            duration = ureg.parse_expression(spi_m['Settings']['Stimulus']['duration']).to(time_unit).magnitude
+            duration = parse_quantity(spi_m['Settings']['Stimulus']['duration'])[0]
 
         start_times = []
 
+        # the spike times are in the unit of the key (usually ms), everything else is in SI units
+        spike_factor, spike_unit = unit_factor(spi_k[0][1]) or (None, None)
+        if spike_unit != time_unit:
+            raise ValueError('Spike times in %s cannot be aligned to trials in %s' % (spi_k[0][1], time_unit))
+
         start_indices = [d[start_index] for d in stim_d]
         for begin_index, trial in zip(start_indices, spi_d):
             start_time = begin_index*sample_interval
             start_times.append(start_time)
-            spike_times.append(trial+start_time)
+            spike_times.append(trial*spike_factor+start_time)
 
 
         start_times = np.asarray(start_times)
@@ -190,10 +176,12 @@ def add_spikes(stimuli, spikefile, spike_times, nix_file, nix_spiketimes):
         tag_name = "%s-run-%i" % (repro, run_idx)
         positions = recording_block.create_data_array(tag_name+'_starts','nix.event.position', nix.DataType.Double, start_times.shape)
         positions.data.write_direct(start_times)
+        positions.unit = time_unit
         positions.append_set_dimension()
 
         extents = recording_block.create_data_array(tag_name+'_extents','nix.event.extents', nix.DataType.Double, durations.shape)
         extents.data.write_direct(durations)
+        extents.unit = time_unit
         extents.append_set_dimension()
 
         tag = recording_block.create_multi_tag(tag_name, 'nix.experiment_run', positions)
@@ -265,18 +253,18 @@ if __name__=="__main__":
     """
 
     if len(sys.argv) < 2:
-        print helptxt
+        print(helptxt)
         sys.exit(3)
     try:
         opts, args = getopt.getopt(sys.argv[1:], "h")
     except:
-        print helptxt
+        print(helptxt)
         sys.exit(2)
 
     # overwrite with parameters
     for opt, arg in opts:
         if opt == '-h':
-            print helptxt
+            print(helptxt)
             sys.exit()
 
     relacsdir, nix_filename = args
@@ -300,6 +288,7 @@ if __name__=="__main__":
     add_info(nix_file, relacsdir, recording_block)
 
     nix_spiketimes = recording_block.create_data_array('spikes', 'nix.event.spiketimes', nix.DataType.Double, (0,))
+    nix_spiketimes.unit = 's'
     nix_spiketimes.append_set_dimension()
 
     #------------ add fi curves-------------------
@@ -321,7 +310,7 @@ if __name__=="__main__":
 
     if len(spike_times) > 0:
         spike_times = np.hstack(spike_times)
-        print "storing %i spikes" % (len(spike_times),)
+        print("storing %i spikes" % (len(spike_times),))
         spike_times.sort()
         nix_spiketimes.data_extent = spike_times.shape # this is not how it's ought to be
         nix_spiketimes[:] = spike_times
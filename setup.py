@@ -10,6 +10,7 @@ setup(
     keywords = "data tool",
     #url = "http://packages.python.org/pycircstat",
     packages=['pyrelacs', 'pyrelacs.DataClasses'],
+    extras_require={'gzip': ['indexed_gzip']},
     #long_description=read('README'),
     classifiers=[
         "Development Status :: 3 - Alpha",
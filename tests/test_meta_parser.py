@@ -0,0 +1,83 @@
+"""
+Regression check of the fast parser of metadata blocks against yaml.
+
+parse_indented_meta handles the plain key: value layout of relacs metadata blocks without yaml.
+Random blocks are parsed with it and with yaml.safe_load, and the whole parse chain of
+_parse_meta_text is compared against _parse_meta_yaml, which uses yaml with the fix_meta_block
+and parse_old_meta fallbacks.
+"""
+import random
+
+import pytest
+import yaml
+
+from pyrelacs.DataClasses import MetaLoaders
+
+KEYS = ['a', 'b', 'duration', 'sample interval1', 'RePro', 'Run', '1', 'on', 'x y z', 'null', 'identifier1',
+        'data file1']
+VALUES = ['1000ms', '0.1', '10', 'V-1', 'trace-1.raw', '-0.5', 'yes', '~', '2016-11-28', '12:30:00', '1e5', '0x1F',
+          '+3', '.5', 'a b c', '-', '0', '007', '1_000', '3.', 'Hz', 'NaN', '.nan', '[1, 2]', '"q"', 'x #c', 'a:b',
+          'x: y', 'Off']
+OLD_STYLE = ['Recording of a P-unit', 'amplitude = 2mV', 'comment = a = b', 'cell: P-unit', 'temperature=26C']
+
+BLOCKS = [
+    ['Dataset:\n', '    Recording:\n', '        Date: 2016-11-28\n', '        Time: 12:30:00\n',
+     '    Subject:\n', '        Species: Apteronotus leptorhynchus\n'],
+    ['analog input traces:\n', '      identifier1: V-1\n', '      data file1: trace-1.raw\n',
+     '      sample interval1: 0.05ms\n', '      unit1: mV\n'],
+    ['RePro: SAM\n', 'Settings:\n', '    Stimulus:\n', '       duration: 1000ms\n', '       contrast: 30%\n',
+     '    Analysis:\n', '       skip: 100ms\n'],
+    [' Recording of a P-unit\n', ' with an old header\n'],
+]
+
+
+def _random_block(rng):
+    lines = []
+    for i in range(rng.randint(1, 7)):
+        if rng.random() < 0.6 or not lines:
+            indent = rng.choice([0, 1, 2, 3, 4, 5, 6, 8, 10])
+        else:
+            indent = len(lines[-1]) - len(lines[-1].lstrip())
+        key = rng.choice(KEYS)
+        if rng.random() < 0.35:
+            lines.append(' ' * indent + key + ':')
+        else:
+            lines.append(' ' * indent + key + ': ' + rng.choice(VALUES))
+    return [line + '\n' for line in lines]
+
+
+def _random_old_block(rng):
+    return [' ' + rng.choice(OLD_STYLE) + '\n' for _ in range(rng.randint(1, 4))]
+
+
+def _blocks(seed, n=2000):
+    rng = random.Random(seed)
+    return BLOCKS + [_random_old_block(rng) if rng.random() < 0.1 else _random_block(rng) for _ in range(n)]
+
+
+def _outcome(func, *args):
+    # the result of func or the type of the exception it raises
+    try:
+        return repr(func(*args)), None
+    except Exception as e:
+        return None, type(e)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_indented_meta_matches_yaml(seed):
+    for lines in _blocks(seed):
+        ret = MetaLoaders.parse_indented_meta(lines)
+        expected, error = _outcome(yaml.safe_load, ''.join(lines))
+        if ret is None:
+            continue  # left to yaml
+        elif ret is MetaLoaders.INVALID:
+            assert error is not None, lines
+        else:
+            assert error is None and repr(ret) == expected, lines
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_parse_meta_text_matches_yaml(seed):
+    for lines in _blocks(seed):
+        expected = _outcome(MetaLoaders._parse_meta_yaml, list(lines))
+        assert _outcome(MetaLoaders._parse_meta_text, ''.join(lines)) == expected, lines